@@ -0,0 +1,90 @@
+import argparse
+import glob
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.cv_utils import YOLOModel, box_iou
+
+
+def load_images(pattern, limit):
+    paths = sorted(glob.glob(pattern))[:limit]
+    if not paths:
+        raise RuntimeError(f"No images match {pattern}")
+    return [(os.path.basename(p), cv2.cvtColor(cv2.imread(p), cv2.COLOR_BGR2RGB)) for p in paths]
+
+
+def run_backend(model, images, classes, warmup):
+    for _, img in images[:warmup]:
+        if classes:
+            model.run_yoloe(img, classes)
+        else:
+            model.predict(img)
+    outputs, latencies = {}, []
+    for name, img in images:
+        start = time.perf_counter()
+        if classes:
+            results = model.run_yoloe(img, classes)
+            outputs[name] = (np.array([r["bbox"] for r in results], dtype=np.float32).reshape(-1, 4),
+                             np.array([r["class_id"] for r in results]))
+        else:
+            detections = model.predict(img)
+            outputs[name] = (detections.xyxy, detections.cls.astype(int))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return outputs, np.array(latencies)
+
+
+def match(reference, candidate, min_iou=0.5):
+    # greedy same-class matching against the PyTorch output
+    ref_boxes, ref_cls = reference
+    boxes, cls = candidate
+    if len(ref_boxes) == 0 or len(boxes) == 0:
+        return 0, len(ref_boxes), len(boxes)
+    iou = np.stack([box_iou(box, boxes) for box in ref_boxes])
+    iou[ref_cls[:, None] != cls[None, :]] = 0
+    matched = 0
+    while iou.size and iou.max() >= min_iou:
+        i, j = np.unravel_index(iou.argmax(), iou.shape)
+        iou[i, :] = 0
+        iou[:, j] = 0
+        matched += 1
+    return matched, len(ref_boxes), len(boxes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare latency and detections of YOLO inference backends")
+    parser.add_argument("images", help="glob of test images, e.g. 'frames/*.jpg'")
+    parser.add_argument("--yolo", default="yolo11n.pt")
+    parser.add_argument("--yoloe", default="yoloe-11l-seg.pt")
+    parser.add_argument("--backends", nargs="+", default=["onnx", "openvino"])
+    parser.add_argument("--int8", action="store_true")
+    parser.add_argument("--classes", nargs="*", default=[], help="benchmark YOLOE with these classes instead")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=5)
+    args = parser.parse_args()
+
+    weights = {"yolo_model": args.yolo, "yoloe_model": args.yoloe}
+    images = load_images(args.images, args.limit)
+    reference, latencies = run_backend(YOLOModel(weights), images, args.classes, args.warmup)
+    print(f"{'backend':<16}{'p50 ms':>10}{'p95 ms':>10}{'recall':>10}{'precision':>11}")
+    print(f"{'torch':<16}{np.percentile(latencies, 50):>10.1f}{np.percentile(latencies, 95):>10.1f}"
+          f"{1.0:>10.3f}{1.0:>11.3f}")
+
+    for backend in args.backends:
+        # the YOLOE vocabulary is baked into the exported graph when the model is built
+        model = YOLOModel(weights, backend, args.int8, args.classes)
+        outputs, latencies = run_backend(model, images, args.classes, args.warmup)
+        matched = ref_total = total = 0
+        for name in reference:
+            m, r, c = match(reference[name], outputs[name])
+            matched, ref_total, total = matched + m, ref_total + r, total + c
+        label = backend + ("-int8" if args.int8 else "")
+        print(f"{label:<16}{np.percentile(latencies, 50):>10.1f}{np.percentile(latencies, 95):>10.1f}"
+              f"{matched / max(ref_total, 1):>10.3f}{matched / max(total, 1):>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import glob
+import os
+import sys
+import time
+import cv2
+import numpy as np
+from pydub import AudioSegment
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.audio_utils import PreparedAudio
+from utils.cv_utils import YOLOModel, PreparedImage, TrackHistory, format_scene
+from utils.llm_utils import LLM
+
+MODES = {
+    "image": {"fmt": "jpeg", "quality": 85, "max_side": 1024, "roi": None},
+    "grounded": {"fmt": "jpeg", "quality": 60, "max_side": 384, "roi": None},
+    "detections": None
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer agreement and latency of image vs detection-grounded prompts")
+    parser.add_argument("images", help="glob of test frames, e.g. 'frames/*.jpg'")
+    parser.add_argument("audio", help="WAV with the spoken question")
+    parser.add_argument("--yolo", default="yolo11n.pt")
+    parser.add_argument("--yoloe", default="yoloe-11l-seg.pt")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--language", default="English")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    key = os.getenv("GEMINI_KEY")
+    if not key:
+        raise RuntimeError("Set GEMINI_KEY to run the harness")
+    paths = sorted(glob.glob(args.images))[:args.limit]
+    if not paths:
+        raise RuntimeError(f"No images match {args.images}")
+
+    yolo_model = YOLOModel({"yolo_model": args.yolo, "yoloe_model": args.yoloe})
+    llm = LLM({"secrets": {"GEMINI_KEY": key}, "model_name": args.model, "language": args.language}, hedge=False)
+    prepared_audio = PreparedAudio(AudioSegment.from_file(args.audio))
+
+    rows = {mode: {"latency": [], "bytes": [], "agreement": []} for mode in MODES}
+    for path in paths:
+        frame = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+        scene = format_scene(TrackHistory().describe(yolo_model.predict(frame), frame.shape))
+        reference = None
+        for mode, image_settings in MODES.items():
+            image = PreparedImage(frame, **image_settings) if image_settings else None
+            start = time.perf_counter()
+            output = llm.get_full_response(image, prepared_audio, None if mode == "image" else scene)
+            rows[mode]["latency"].append(time.perf_counter() - start)
+            rows[mode]["bytes"].append((image.size if image else 0) + (len(scene) if mode != "image" else 0))
+            objects = set(o.lower() for o in output.get("object_list") or [])
+            # the full-image answer is the reference the cheaper modes are compared with
+            if reference is None:
+                reference = objects
+            union = reference | objects
+            rows[mode]["agreement"].append(len(reference & objects) / len(union) if union else 1.0)
+
+    print(f"{'mode':<12}{'p50 s':>8}{'p95 s':>8}{'payload KB':>12}{'objects':>10}")
+    for mode, row in rows.items():
+        print(f"{mode:<12}{np.percentile(row['latency'], 50):>8.2f}{np.percentile(row['latency'], 95):>8.2f}"
+              f"{np.mean(row['bytes']) / 1024:>12.1f}{np.mean(row['agreement']):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
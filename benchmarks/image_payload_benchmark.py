@@ -0,0 +1,76 @@
+import argparse
+import glob
+import os
+import sys
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.cv_utils import PreparedImage
+
+CONFIGS = [
+    {"fmt": "png", "quality": 0, "max_side": None, "roi": None},
+    {"fmt": "jpeg", "quality": 90, "max_side": None, "roi": None},
+    {"fmt": "jpeg", "quality": 85, "max_side": 1024, "roi": None},
+    {"fmt": "jpeg", "quality": 75, "max_side": 768, "roi": None},
+    {"fmt": "webp", "quality": 80, "max_side": 1024, "roi": None},
+    {"fmt": "jpeg", "quality": 85, "max_side": 1024, "roi": 0.7},
+]
+
+
+def label(config):
+    roi = f" roi={config['roi']}" if config["roi"] else ""
+    return f"{config['fmt']} q={config['quality']} max={config['max_side'] or 'full'}{roi}"
+
+
+def ask(llm, prepared_image, prepared_audio):
+    output = llm.get_full_response(prepared_image, prepared_audio)
+    return output.get("response_text", ""), set(o.lower() for o in output.get("object_list") or [])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode time and payload size of LLM image settings")
+    parser.add_argument("images", help="glob of test frames, e.g. 'frames/*.jpg'")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--audio", help="WAV question; with GEMINI_KEY set, answers are compared to the PNG ones")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--language", default="English")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(args.images))[:args.limit]
+    if not paths:
+        raise RuntimeError(f"No images match {args.images}")
+    images = [cv2.cvtColor(cv2.imread(p), cv2.COLOR_BGR2RGB) for p in paths]
+
+    llm = prepared_audio = None
+    if args.audio and os.getenv("GEMINI_KEY"):
+        from pydub import AudioSegment
+        from utils.audio_utils import PreparedAudio
+        from utils.llm_utils import LLM
+        llm = LLM({"secrets": {"GEMINI_KEY": os.getenv("GEMINI_KEY")}, "model_name": args.model,
+                   "language": args.language})
+        prepared_audio = PreparedAudio(AudioSegment.from_file(args.audio))
+
+    reference = {}
+    print(f"{'setting':<32}{'encode ms':>11}{'size KB':>10}{'objects':>10}")
+    for config in CONFIGS:
+        encode_ms, sizes, agreement = [], [], []
+        for i, img in enumerate(images):
+            for _ in range(args.repeat):
+                prepared_image = PreparedImage(img, **config)
+                encode_ms.append(prepared_image.encode_ms)
+            sizes.append(prepared_image.size / 1024)
+            if llm is not None:
+                # answers to the lossless full-size frame are the reference
+                text, objects = ask(llm, prepared_image, prepared_audio)
+                if config is CONFIGS[0]:
+                    reference[i] = objects
+                union = reference[i] | objects
+                agreement.append(len(reference[i] & objects) / len(union) if union else 1.0)
+        quality = f"{np.mean(agreement):>10.2f}" if agreement else f"{'-':>10}"
+        print(f"{label(config):<32}{np.median(encode_ms):>11.1f}{np.mean(sizes):>10.0f}{quality}")
+
+
+if __name__ == "__main__":
+    main()
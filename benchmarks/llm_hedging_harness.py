@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import numpy as np
+from google import genai
+from google.genai import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.async_utils import ResilientCaller, RetryBudget, LatencyTracker
+from utils.llm_utils import LLM, PromptCache, is_retryable
+
+ANSWER = json.dumps({"response": "Door ahead, two steps. Stairs on your left.", "search_objects": ["door", "stairs"]})
+
+
+def make_handler(args):
+    class FakeGeminiHandler(BaseHTTPRequestHandler):
+        def log_message(self, *_):
+            pass
+
+        def reply(self, status, body):
+            data = json.dumps(body).encode()
+            try:
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # the losing request of a hedged pair is cancelled by the client
+                pass
+
+        def do_PATCH(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.reply(200, {"name": "cachedContents/fake"})
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if "cachedContents" in self.path:
+                self.reply(200, {"name": "cachedContents/fake"})
+                return
+            # most requests take the base latency; a few land in a slow tail or fail outright
+            latency = random.lognormvariate(np.log(args.latency_ms), 0.25) / 1000
+            if random.random() < args.tail_rate:
+                latency += args.tail_ms / 1000
+            time.sleep(latency)
+            if random.random() < args.error_rate:
+                self.reply(503, {"error": {"code": 503, "message": "overloaded", "status": "UNAVAILABLE"}})
+                return
+            self.reply(200, {"candidates": [{"content": {"role": "model", "parts": [{"text": ANSWER}]},
+                                             "finishReason": "STOP"}]})
+
+    return FakeGeminiHandler
+
+
+def run(args, client, hedge):
+    session = {"secrets": {"GEMINI_KEY": "fake"}, "model_name": "gemini-2.5-flash", "language": "English"}
+    llm = LLM(session, client, PromptCache(client), timeout=args.timeout, max_retries=args.max_retries)
+    # fresh budget and latency history so the two runs do not share state
+    llm.caller = ResilientCaller(RetryBudget(), LatencyTracker(), max_retries=args.max_retries,
+                                 retryable=is_retryable, hedge=hedge)
+    image = SimpleNamespace(mime_type="image/jpeg", data=b"\xff\xd8fake")
+    audio = SimpleNamespace(mime_type="audio/flac", data="ZmFrZQ==")
+
+    def ask(_):
+        start = time.perf_counter()
+        try:
+            llm.get_full_response(image, audio)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, e
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(ask, range(args.requests)))
+    latencies = np.array([latency for latency, error in results if error is None]) * 1000
+    errors = sum(error is not None for _, error in results)
+    return latencies, errors, llm.caller.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tail latency of LLM calls with and without hedging, "
+                                                 "against a local fake Gemini endpoint")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--tail-rate", type=float, default=0.05)
+    parser.add_argument("--tail-ms", type=float, default=4000)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--max-retries", type=int, default=2)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = genai.Client(api_key="fake",
+                          http_options=types.HttpOptions(base_url=f"http://127.0.0.1:{server.server_port}"))
+
+    print(f"{'mode':<10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}{'retries':>9}{'hedges':>8}"
+          f"{'won':>6}{'denied':>8}")
+    for hedge in (False, True):
+        latencies, errors, stats = run(args, client, hedge)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0, 0, 0)
+        print(f"{'hedged' if hedge else 'plain':<10}{p50:>9.0f}{p95:>9.0f}{p99:>9.0f}{errors:>8}"
+              f"{stats['retries']:>9}{stats['hedges']:>8}{stats['hedge_wins']:>6}{stats['budget']['denied']:>8}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import numpy as np
+from pydub import AudioSegment
+from utils.audio_utils import PreparedAudio
+from utils.llm_utils import AnswerCache
+
+
+CONTEXT = ("English", "gemini-2.5-flash", "image")
+
+
+def utterance(pitches, seed, sample_rate=44100, duration_s=2.0):
+    # voiced syllables with different pitch contours, framed by silence, all the same length
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(sample_rate * duration_s)) / sample_rate
+    signal = np.zeros_like(t)
+    syllable = (duration_s - 0.8) / len(pitches)
+    for i, pitch in enumerate(pitches):
+        mask = (t >= 0.4 + i * syllable) & (t < 0.4 + (i + 0.8) * syllable)
+        signal[mask] = 0.4 * np.sin(2 * np.pi * pitch * t[mask]) + 0.2 * np.sin(4 * np.pi * pitch * t[mask])
+    signal += 0.001 * rng.standard_normal(len(t))
+    pcm = (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+    return AudioSegment(pcm.tobytes(), sample_width=2, frame_rate=sample_rate, channels=1)
+
+
+def test_different_questions_about_the_same_frame_do_not_collide():
+    door = PreparedAudio(utterance([180, 220, 200], seed=1), fmt="wav")
+    stairs = PreparedAudio(utterance([190, 210, 230], seed=2), fmt="wav")
+    assert door.fingerprint != stairs.fingerprint
+
+    cache = AnswerCache()
+    frame_hash = 0x0F0F0F0F0F0F0F0F
+    cache.store(frame_hash, door.fingerprint, CONTEXT, {"response_text": "The door is ahead."}, 3600)
+    assert cache.lookup(frame_hash, stairs.fingerprint, CONTEXT, 3600) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_same_recording_on_a_near_identical_frame_hits():
+    recording = utterance([180, 220, 200], seed=1)
+    first, again = PreparedAudio(recording, fmt="wav"), PreparedAudio(recording, fmt="wav")
+    cache = AnswerCache(frame_threshold=6)
+    cache.store(0b1010, first.fingerprint, CONTEXT, {"response_text": "The door is ahead."}, 3600)
+    assert cache.lookup(0b1011, again.fingerprint, CONTEXT, 3600) == {"response_text": "The door is ahead."}
+    assert cache.lookup(0b1011, again.fingerprint, ("Nederlands", "gemini-2.5-flash", "image"), 3600) is None
+
+
+def test_entries_expire_and_are_evicted():
+    cache = AnswerCache(max_entries=2)
+    for i in range(3):
+        cache.store(i, f"question-{i}", CONTEXT, {"response_text": str(i)}, 3600)
+    assert cache.lookup(0, "question-0", CONTEXT, 3600) is None
+    assert cache.lookup(2, "question-2", CONTEXT, 0) is None
+    assert cache.stats()["evicted"] == 1
+
+
+def test_answers_are_not_shared_across_models_or_prompt_modes():
+    cache = AnswerCache()
+    cache.store(0b1010, "question", CONTEXT, {"response_text": "The door is ahead."}, 3600)
+    assert cache.lookup(0b1010, "question", ("English", "gemini-2.5-pro", "image"), 3600) is None
+    assert cache.lookup(0b1010, "question", ("English", "gemini-2.5-flash", "detections"), 3600) is None
+    assert cache.lookup(0b1010, "question", CONTEXT, 3600) == {"response_text": "The door is ahead."}
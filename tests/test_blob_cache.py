@@ -0,0 +1,55 @@
+import logging
+from types import SimpleNamespace
+import pytest
+from utils.storage_utils import BlobCache
+
+CHUNK = 1024
+DATA = bytes(range(256)) * 18
+
+
+class FakeBlobClient:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.offsets = []
+
+    def get_blob_properties(self):
+        return SimpleNamespace(size=len(DATA), etag='"v1"')
+
+    def download_blob(self, offset, length, etag, match_condition):
+        if self.fail:
+            raise ConnectionError("connection reset")
+        self.offsets.append(offset)
+        return SimpleNamespace(readall=lambda: DATA[offset:offset + length])
+
+
+class FakeContainerClient:
+    container_name = "videos"
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def get_blob_client(self, blob_name):
+        return self.blobs[blob_name]
+
+
+def test_blob_cache_downloads_each_version_once(tmp_path):
+    blob = FakeBlobClient()
+    cache = BlobCache(FakeContainerClient({"streamlit_videos/a.mp4": blob}), cache_dir=str(tmp_path),
+                      chunk_size=CHUNK)
+    path = cache.fetch("streamlit_videos/a.mp4")
+    assert cache.fetch("streamlit_videos/a.mp4") == path
+    assert len(blob.offsets) == 5
+    assert cache.lookup("streamlit_videos/a.mp4", '"v1"') == path
+    assert cache.lookup("streamlit_videos/a.mp4", '"v2"') is None
+
+
+def test_failed_background_fetch_is_logged(tmp_path, caplog):
+    cache = BlobCache(FakeContainerClient({"streamlit_videos/a.mp4": FakeBlobClient(fail=True)}),
+                      cache_dir=str(tmp_path), chunk_size=CHUNK)
+    with caplog.at_level(logging.WARNING, logger="utils.storage_utils"):
+        future = cache.fetch_async("streamlit_videos/a.mp4")
+        with pytest.raises(ConnectionError):
+            future.result(timeout=5)
+        cache.fetch_executor.shutdown(wait=True)
+    assert "streamlit_videos/a.mp4" in caplog.text
+    assert cache.pending == {}
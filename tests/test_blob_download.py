@@ -0,0 +1,48 @@
+import os
+from types import SimpleNamespace
+import pytest
+from utils.storage_utils import download_blob_to_file
+
+CHUNK = 1024
+DATA = bytes(range(256)) * 18  # five chunks, the last one partial
+
+
+class FakeBlobClient:
+    def __init__(self, data=DATA, fail_at=None):
+        self.data = data
+        self.fail_at = fail_at
+        self.offsets = []
+
+    def download_blob(self, offset, length, etag, match_condition):
+        if offset == self.fail_at:
+            raise ConnectionError("connection reset")
+        self.offsets.append(offset)
+        return SimpleNamespace(readall=lambda: self.data[offset:offset + length])
+
+
+def test_interrupted_download_resumes_from_the_missing_chunks(tmp_path):
+    path = str(tmp_path / "video.mp4")
+    with pytest.raises(ConnectionError):
+        download_blob_to_file(FakeBlobClient(fail_at=3 * CHUNK), path, len(DATA), '"v1"', CHUNK, max_workers=1)
+    assert not os.path.exists(path)
+    assert os.path.exists(path + ".state")
+
+    resumed = FakeBlobClient()
+    download_blob_to_file(resumed, path, len(DATA), '"v1"', CHUNK, max_workers=1)
+    # the chunks after the failed one were still written before the error surfaced
+    assert resumed.offsets == [3 * CHUNK]
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + ".part") and not os.path.exists(path + ".state")
+
+
+def test_partial_download_of_a_changed_blob_starts_over(tmp_path):
+    path = str(tmp_path / "video.mp4")
+    with pytest.raises(ConnectionError):
+        download_blob_to_file(FakeBlobClient(fail_at=3 * CHUNK), path, len(DATA), '"v1"', CHUNK, max_workers=1)
+
+    changed = FakeBlobClient(data=DATA[::-1])
+    download_blob_to_file(changed, path, len(DATA), '"v2"', CHUNK, max_workers=1)
+    assert sorted(changed.offsets) == list(range(0, len(DATA), CHUNK))
+    with open(path, "rb") as f:
+        assert f.read() == DATA[::-1]
@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+import aiohttp
+import pytest
+from google.genai import errors
+from utils.llm_utils import LLM, PromptCache
+
+ANSWER = '{"response": "The door is ahead. Stairs on your left.", "search_objects": ["door", "stairs"]}'
+SESSION = {"secrets": {"GEMINI_KEY": "fake"}, "model_name": "gemini-2.5-flash", "language": "English"}
+IMAGE = SimpleNamespace(mime_type="image/jpeg", data=b"\xff\xd8fake")
+AUDIO = SimpleNamespace(mime_type="audio/flac", data="ZmFrZQ==")
+
+
+def client_error(code, status):
+    return errors.ClientError(code, {"error": {"code": code, "message": status.lower(), "status": status}})
+
+
+class FakeModels:
+    def __init__(self, cached_error=None, transient_errors=()):
+        # requests that use the cached prompt fail with cached_error; inline requests answer
+        self.cached_error = cached_error
+        self.transient_errors = list(transient_errors)
+        self.configs = []
+
+    async def generate_content(self, model, contents, config):
+        self.configs.append(config)
+        if self.transient_errors:
+            raise self.transient_errors.pop(0)
+        if config.cached_content and self.cached_error:
+            raise self.cached_error
+        return SimpleNamespace(text=ANSWER)
+
+    async def generate_content_stream(self, model, contents, config):
+        self.configs.append(config)
+        cached_error = self.cached_error if config.cached_content else None
+
+        async def chunks():
+            if cached_error:
+                raise cached_error
+            for start in range(0, len(ANSWER), 16):
+                yield SimpleNamespace(text=ANSWER[start:start + 16])
+
+        return chunks()
+
+
+class FakeCaches:
+    def __init__(self):
+        self.created = []
+        self.deleted = []
+
+    def create(self, model, config):
+        self.created.append(config)
+        return SimpleNamespace(name=f"cachedContents/{len(self.created)}")
+
+    def update(self, name, config):
+        pass
+
+    def delete(self, name, config=None):
+        self.deleted.append(name)
+
+
+def make_llm(cached_error=None, transient_errors=()):
+    client = SimpleNamespace(aio=SimpleNamespace(models=FakeModels(cached_error, transient_errors)),
+                             caches=FakeCaches())
+    return LLM(SESSION, client, PromptCache(client), timeout=5, hedge=False), client
+
+
+def test_cached_prompt_is_used_when_available():
+    llm, client = make_llm()
+    output = llm.get_full_response(IMAGE, AUDIO)
+    assert output["object_list"] == ["door", "stairs"]
+    assert [c.cached_content for c in client.aio.models.configs] == ["cachedContents/1"]
+
+
+def test_expired_cache_falls_back_to_the_inline_prompt():
+    llm, client = make_llm(client_error(404, "NOT_FOUND"))
+    output = llm.get_full_response(IMAGE, AUDIO)
+    assert output["response_text"] == "The door is ahead. Stairs on your left."
+    first, second = client.aio.models.configs
+    assert first.cached_content == "cachedContents/1"
+    assert second.cached_content is None and second.system_instruction == llm.prompt
+    assert client.caches.deleted == ["cachedContents/1"]
+
+
+def test_bad_request_is_not_retried_without_the_cache():
+    llm, client = make_llm(client_error(400, "INVALID_ARGUMENT"))
+    with pytest.raises(errors.ClientError):
+        llm.get_full_response(IMAGE, AUDIO)
+    assert len(client.aio.models.configs) == 1
+    assert client.caches.deleted == []
+
+
+def test_streamed_answer_falls_back_when_the_cache_is_gone():
+    llm, client = make_llm(client_error(403, "PERMISSION_DENIED"))
+    events = list(llm.stream_full_response(IMAGE, AUDIO))
+    assert [value for event, value in events if event == "sentence"] == ["The door is ahead.", "Stairs on your left."]
+    assert events[-1][1]["object_list"] == ["door", "stairs"]
+    assert client.caches.deleted == ["cachedContents/1"]
+
+
+def test_dropped_aiohttp_connection_is_retried():
+    llm, client = make_llm(transient_errors=[aiohttp.ServerDisconnectedError()])
+    output = llm.get_full_response(IMAGE, AUDIO)
+    assert output["object_list"] == ["door", "stairs"]
+    assert len(client.aio.models.configs) == 2
+    assert llm.caller.stats()["retries"] == 1
+
+
+def test_streamed_and_full_answers_keep_separate_latency_histories():
+    llm, _ = make_llm()
+    list(llm.stream_full_response(IMAGE, AUDIO))
+    assert len(llm.stream_caller.latency.samples) == 1
+    assert len(llm.caller.latency.samples) == 0
+    llm.get_full_response(IMAGE, AUDIO)
+    assert len(llm.caller.latency.samples) == 1
@@ -0,0 +1,91 @@
+import asyncio
+import time
+import pytest
+from utils.async_utils import ResilientCaller, RetryBudget, LatencyTracker
+
+
+class Overloaded(Exception):
+    pass
+
+
+def make_caller(budget=None, latency=None, max_retries=2, hedge=False):
+    return ResilientCaller(budget or RetryBudget(), latency or LatencyTracker(), max_retries=max_retries,
+                           base_delay=0.001, max_delay=0.001,
+                           retryable=lambda e: isinstance(e, Overloaded), hedge=hedge)
+
+
+def test_transient_error_is_retried():
+    caller = make_caller()
+    attempts = []
+
+    async def request():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise Overloaded()
+        return "answer"
+
+    assert asyncio.run(caller.call(request, timeout=5)) == "answer"
+    assert len(attempts) == 2
+    assert caller.stats()["retries"] == 1
+
+
+def test_retries_stay_within_the_budget():
+    budget = RetryBudget(ratio=0, min_tokens=2)
+    caller = make_caller(budget, max_retries=5)
+    attempts = []
+
+    async def request():
+        attempts.append(time.monotonic())
+        raise Overloaded()
+
+    with pytest.raises(Overloaded):
+        asyncio.run(caller.call(request, timeout=5))
+    # the first try plus one retry per token, even though max_retries would allow five
+    assert len(attempts) == 3
+    assert budget.stats()["spent"] == 2
+    assert budget.stats()["denied"] == 1
+
+
+def test_non_retryable_error_is_raised_at_once():
+    caller = make_caller()
+    attempts = []
+
+    async def request():
+        attempts.append(time.monotonic())
+        raise ValueError("bad audio")
+
+    with pytest.raises(ValueError):
+        asyncio.run(caller.call(request, timeout=5))
+    assert len(attempts) == 1
+
+
+def test_hedge_wins_over_a_slow_primary():
+    latency = LatencyTracker(min_samples=1)
+    latency.add(0.02)
+    caller = make_caller(latency=latency, hedge=True)
+    delays = iter([2.0, 0.0])
+
+    async def request():
+        delay = next(delays)
+        await asyncio.sleep(delay)
+        return delay
+
+    start = time.monotonic()
+    assert asyncio.run(caller.call(request, timeout=5)) == 0.0
+    assert time.monotonic() - start < 1.0
+    stats = caller.stats()
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+
+
+def test_deadline_covers_all_attempts():
+    caller = make_caller()
+
+    async def request():
+        await asyncio.sleep(10)
+
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        asyncio.run(caller.call(request, timeout=0.2))
+    assert time.monotonic() - start < 1.0
+    assert caller.stats()["timeouts"] == 1
@@ -0,0 +1,38 @@
+import json
+from utils.llm_utils import StreamingResponseParser
+
+
+def feed_in_chunks(raw, size):
+    parser = StreamingResponseParser()
+    events = []
+    for start in range(0, len(raw), size):
+        events.extend(parser.feed(raw[start:start + size]))
+    events.extend(parser.close())
+    return events
+
+
+def sentences(events):
+    return [value for event, value in events if event == "sentence"]
+
+
+def test_sentences_are_emitted_as_they_complete():
+    raw = json.dumps({"search_objects": ["door"], "response": "The door is ahead. Stairs on your left."})
+    events = feed_in_chunks(raw, 7)
+    assert ("search_objects", ["door"]) in events
+    assert sentences(events) == ["The door is ahead.", "Stairs on your left."]
+
+
+def test_surrogate_pair_split_across_chunks_is_one_character():
+    raw = json.dumps({"response": "Well done \U0001F600 café. Next.", "search_objects": []})
+    assert "\\ud83d\\ude00" in raw
+    for size in range(1, 16):
+        events = feed_in_chunks(raw, size)
+        assert sentences(events) == ["Well done \U0001F600 café.", "Next."]
+        for sentence in sentences(events):
+            sentence.encode("utf-8")
+
+
+def test_unpaired_surrogate_is_replaced():
+    raw = '{"response": "Odd \\ud83d text. Also \\ude00 here.", "search_objects": []}'
+    events = feed_in_chunks(raw, 5)
+    assert sentences(events) == ["Odd � text.", "Also � here."]
@@ -0,0 +1,88 @@
+import threading
+import time
+import pytest
+from utils.audio_utils import SpeechSynthesizerPool
+
+
+class FakeSynthesizer:
+    def __init__(self, fail=False, delay=0.0):
+        self.fail = fail
+        self.delay = delay
+        self.texts = []
+
+    def stream(self, text):
+        self.texts.append(text)
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("Speech synthesis canceled")
+        yield b"\x01\x00" * len(text)
+        yield b"\x00\x00" * 10
+
+
+def make_pool(synthesizers, **kwargs):
+    created = []
+
+    def factory():
+        synthesizer = synthesizers[len(created)]
+        created.append(synthesizer)
+        return synthesizer
+
+    return SpeechSynthesizerPool(factory, "en-US-JennyNeural", **kwargs), created
+
+
+def test_synthesizer_is_reused_between_phrases():
+    pool, created = make_pool([FakeSynthesizer(), FakeSynthesizer()])
+    pool.synthesize("The door is ahead.")
+    pool.synthesize("Stairs on your left.")
+    assert len(created) == 1
+    assert created[0].texts == ["The door is ahead.", "Stairs on your left."]
+
+
+def test_repeated_phrase_is_served_from_the_cache():
+    pool, created = make_pool([FakeSynthesizer()])
+    first = pool.synthesize("Stop!")
+    again = pool.synthesize("  stop! ")
+    assert first == again
+    assert created[0].texts == ["Stop!"]
+    assert pool.stats()["hits"] == 1
+
+
+def test_phrase_cache_is_bounded_by_bytes():
+    pool, _ = make_pool([FakeSynthesizer()], max_cache_bytes=100)
+    for phrase in ("Stop.", "Careful.", "Step down.", "Door on your right."):
+        pool.synthesize(phrase)
+    stats = pool.stats()
+    assert 0 < stats["cache_bytes"] <= 100
+    assert stats["cache_entries"] < 4
+
+
+def test_waiter_gets_a_new_synthesizer_when_the_busy_one_fails():
+    pool, created = make_pool([FakeSynthesizer(fail=True, delay=0.2), FakeSynthesizer()], size=1,
+                              acquire_timeout=5)
+    failures = []
+
+    def speak():
+        try:
+            pool.synthesize("The door is ahead.")
+        except RuntimeError as e:
+            failures.append(e)
+
+    thread = threading.Thread(target=speak)
+    thread.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    pool.synthesize("Stairs on your left.")
+    thread.join()
+    assert time.monotonic() - start < 2
+    assert len(failures) == 1
+    assert len(created) == 2
+    assert pool.stats()["synthesizers"] == 1
+
+
+def test_acquire_gives_up_after_its_timeout():
+    pool, _ = make_pool([FakeSynthesizer()], size=1, acquire_timeout=0.1)
+    held = pool.acquire()
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+    pool.release(held)
+    assert pool.acquire() is held
@@ -0,0 +1,178 @@
+import asyncio
+import concurrent.futures
+import random
+import threading
+from collections import deque
+import numpy as np
+import streamlit as st
+
+
+class BackgroundLoop:
+    def __init__(self):
+        # async SDK clients bind their connection pools to one loop, so every coroutine runs on this one
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="async-loop", daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine, timeout=None):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+
+class RetryBudget:
+    def __init__(self, ratio=0.1, min_tokens=3, max_tokens=10):
+        # every request earns `ratio` of a retry; retries and hedges spend whole ones
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(min_tokens)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.spent = 0
+        self.denied = 0
+
+    def deposit(self):
+        with self.lock:
+            self.requests += 1
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                self.denied += 1
+                return False
+            self.tokens -= 1
+            self.spent += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {"requests": self.requests, "tokens": self.tokens, "spent": self.spent, "denied": self.denied}
+
+
+class LatencyTracker:
+    def __init__(self, window=200, min_samples=20, percentile=95):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def threshold(self):
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            return float(np.percentile(self.samples, self.percentile))
+
+
+class ResilientCaller:
+    def __init__(self, budget, latency, max_retries=2, base_delay=0.25, max_delay=2.0, retryable=None, hedge=True):
+        self.budget = budget
+        self.latency = latency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable = retryable
+        self.hedge = hedge
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+
+    def is_retryable(self, error):
+        if isinstance(error, asyncio.TimeoutError):
+            return True
+        return self.retryable is not None and self.retryable(error)
+
+    async def call(self, make_call, timeout):
+        # make_call returns a fresh coroutine per attempt; timeout is the deadline for all attempts together
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            remaining = deadline - loop.time()
+            try:
+                return await asyncio.wait_for(self.attempt(make_call), remaining)
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError) and deadline - loop.time() <= 0:
+                    self.timeouts += 1
+                    raise TimeoutError(f"LLM request exceeded its {timeout}s deadline") from e
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                # full jitter keeps sessions that failed together from retrying together
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if loop.time() + delay >= deadline or not self.budget.withdraw():
+                    raise
+                attempt += 1
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    async def attempt(self, make_call):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        primary = asyncio.ensure_future(make_call())
+        threshold = self.latency.threshold() if self.hedge else None
+        try:
+            if threshold is not None:
+                done, _ = await asyncio.wait({primary}, timeout=threshold)
+                if not done and self.budget.withdraw():
+                    # the primary is in the slow tail: race a duplicate and keep whichever answers first
+                    self.hedges += 1
+                    backup = asyncio.ensure_future(make_call())
+                    result, winner = await self.first_success(primary, backup)
+                    self.hedge_wins += winner is backup
+                    self.latency.add(loop.time() - start)
+                    return result
+            result = await primary
+            self.latency.add(loop.time() - start)
+            return result
+        finally:
+            primary.cancel()
+
+    @staticmethod
+    async def first_success(*tasks):
+        pending = set(tasks)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result(), task
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return {
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "timeouts": self.timeouts,
+            "hedge_after_s": self.latency.threshold(),
+            "budget": self.budget.stats()
+        }
+
+
+@st.cache_resource
+def get_background_loop():
+    return BackgroundLoop()
+
+
+@st.cache_resource
+def get_retry_budget():
+    return RetryBudget()
+
+
+@st.cache_resource
+def get_latency_tracker(model_name, kind):
+    return LatencyTracker()
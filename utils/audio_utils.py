@@ -1,39 +1,258 @@
 from io import BytesIO
 import base64
+import hashlib
+import threading
+import time
+import wave
+from collections import OrderedDict
+import numpy as np
+import streamlit as st
 import azure.cognitiveservices.speech as speechsdk
+from utils.resource_utils import get_speech_config
+
+
+VOICES = {
+    "English": "en-GB-RyanNeural",
+    "Nederlands": "nl-NL-FennaNeural",
+    "Vlaams": "nl-BE-DenaNeural",
+    "Deutsch": "de-DE-SeraphinaMultilingualNeural",
+    "Français": "fr-FR-VivienneMultilingualNeural"
+}
+
+
+TTS_SAMPLE_RATE = 24000
+
+
+class AzureSynthesizer:
+    def __init__(self, config):
+        # audio_config=None keeps the audio in memory instead of playing or writing it
+        self.synthesizer = speechsdk.SpeechSynthesizer(speech_config=config, audio_config=None)
+
+    def stream(self, text, chunk_size=16384):
+        # start_speaking returns once the first audio arrives; the data stream is pulled as it is synthesized
+        result = self.synthesizer.start_speaking_text_async(text).get()
+        if result.reason == speechsdk.ResultReason.Canceled:
+            raise RuntimeError(f"Speech synthesis canceled: {result.cancellation_details.error_details}")
+        stream = speechsdk.AudioDataStream(result)
+        buffer = bytes(chunk_size)
+        while True:
+            filled = stream.read_data(buffer)
+            if filled == 0:
+                break
+            yield buffer[:filled]
+        if stream.status == speechsdk.StreamStatus.Canceled:
+            raise RuntimeError(f"Speech synthesis canceled: {stream.cancellation_details.error_details}")
+
+
+def normalize_phrase(text):
+    return " ".join(text.split()).casefold()
+
+
+def pcm_to_wav(pcm, sample_rate=TTS_SAMPLE_RATE):
+    buffer = BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
+class SpeechSynthesizerPool:
+    def __init__(self, synthesizer_factory, voice, size=2, acquire_timeout=30, max_cache_bytes=16 * 1024 ** 2,
+                 max_cached_chars=200):
+        self.synthesizer_factory = synthesizer_factory
+        self.voice = voice
+        self.size = size
+        self.acquire_timeout = acquire_timeout
+        self.max_cache_bytes = max_cache_bytes
+        self.max_cached_chars = max_cached_chars
+        self.idle = []
+        self.created = 0
+        self.lock = threading.Lock()
+        # woken whenever a synthesizer is returned or a slot frees up, so waiters never outlive the pool's members
+        self.available = threading.Condition(self.lock)
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.first_chunk_ms = None
+
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self.available:
+            while not self.idle and self.created >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError("No speech synthesizer became available")
+                self.available.wait(remaining)
+            if self.idle:
+                return self.idle.pop()
+            self.created += 1
+        try:
+            return self.synthesizer_factory()
+        except Exception:
+            self.discard()
+            raise
+
+    def release(self, synthesizer):
+        with self.available:
+            self.idle.append(synthesizer)
+            self.available.notify()
+
+    def discard(self):
+        with self.available:
+            self.created -= 1
+            self.available.notify()
+
+    def stream(self, text):
+        # yields raw PCM chunks; short phrases (typically hazard warnings) are served from the cache
+        key = (self.voice, normalize_phrase(text))
+        with self.lock:
+            pcm = self.cache.get(key)
+            if pcm is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if pcm is not None:
+            yield pcm
+            return
+        start = time.perf_counter()
+        chunks = []
+        synthesizer = self.acquire()
+        try:
+            for chunk in synthesizer.stream(text):
+                if not chunks:
+                    self.first_chunk_ms = 1000 * (time.perf_counter() - start)
+                chunks.append(chunk)
+                yield chunk
+        except BaseException:
+            # a failed or abandoned synthesizer may still be mid-utterance, so it is not reused
+            self.discard()
+            raise
+        self.release(synthesizer)
+        if len(key[1]) <= self.max_cached_chars:
+            self.store(key, b"".join(chunks))
+
+    def store(self, key, pcm):
+        # bounded by bytes: one long sentence costs as much as dozens of one-word warnings
+        if len(pcm) > self.max_cache_bytes:
+            return
+        with self.lock:
+            previous = self.cache.pop(key, None)
+            if previous is not None:
+                self.cache_bytes -= len(previous)
+            self.cache[key] = pcm
+            self.cache_bytes += len(pcm)
+            while self.cache_bytes > self.max_cache_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cache_bytes -= len(evicted)
+
+    def synthesize(self, text):
+        return pcm_to_wav(b"".join(self.stream(text)))
+
+    def stats(self):
+        return {
+            "synthesizers": self.created,
+            "cache_entries": len(self.cache),
+            "cache_bytes": self.cache_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "first_chunk_ms": self.first_chunk_ms
+        }
+
+
+@st.cache_resource
+def get_synthesizer_pool(key, region, voice):
+    config = get_speech_config(key, region, voice)
+    return SpeechSynthesizerPool(lambda: AzureSynthesizer(config), voice)
 
 
 def text_to_speech(session, text):
-    voices = {
-        "English": "en-GB-RyanNeural",
-        "Nederlands": "nl-NL-FennaNeural",
-        "Vlaams": "nl-BE-DenaNeural",
-        "Deutsch": "de-DE-SeraphinaMultilingualNeural",
-        "Français": "fr-FR-VivienneMultilingualNeural"
-    }
     key = session["secrets"]["TTS_KEY"]
     region = session["secrets"]["TTS_REGION"]
-    config = speechsdk.SpeechConfig(subscription=key, region=region)
-    language = session["language"]
-    config.speech_synthesis_voice_name = voices[language]
-
-    synthesizer = speechsdk.SpeechSynthesizer(
-        speech_config=config,
-        audio_config=speechsdk.audio.AudioOutputConfig(filename=rf"C:\Users\Eugenia\Downloads\tts_{language}.wav")
-    )
-
-    result = synthesizer.speak_text_async(text).get()
-    if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-        audio_bytes = BytesIO(result.audio_data)
-        audio_base64 = base64.b64encode(result.audio_data).decode()
-        return audio_bytes, audio_base64
-    else:
+    pool = get_synthesizer_pool(key, region, VOICES[session["language"]])
+    try:
+        wav_bytes = pool.synthesize(text)
+    except RuntimeError:
         return None
+    return BytesIO(wav_bytes), base64.b64encode(wav_bytes).decode()
+
+
+AUDIO_FORMATS = {
+    "wav": ("wav", None, "audio/wav"),
+    "flac": ("flac", None, "audio/flac"),
+    "opus": ("ogg", "libopus", "audio/ogg")
+}
+
+
+def audio_fingerprint(audio):
+    # exact digest of the trimmed 16 kHz mono PCM: only the same recording matches, never a different question
+    return hashlib.sha256(audio.raw_data).hexdigest()
+
+
+class PreparedAudio:
+    def __init__(self, audio, fmt="flac", sample_rate=16000, frame_ms=20, threshold_db=35, floor_db=-55,
+                 padding_ms=200):
+        if fmt not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported audio format: {fmt}")
+        self.fmt = fmt
+        self.source_duration_s = audio.duration_seconds
+        # what the recording costs as 16-bit PCM WAV, which is what used to be uploaded
+        self.source_bytes = len(audio.raw_data) + 44
+        audio = self.trim(audio, frame_ms, threshold_db, floor_db, padding_ms)
+        audio = audio.set_channels(1).set_frame_rate(sample_rate)
+        self.duration_s = audio.duration_seconds
+        self.fingerprint = audio_fingerprint(audio)
+        export_format, codec, self.mime_type = AUDIO_FORMATS[fmt]
+        buffer = BytesIO()
+        audio.export(buffer, format=export_format, codec=codec)
+        self.size = len(buffer.getvalue())
+        self.data = base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+    @staticmethod
+    def trim(audio, frame_ms, threshold_db, floor_db, padding_ms):
+        # energy VAD: keep from the first to the last frame within threshold_db of the loudest one
+        samples = np.array(audio.get_array_of_samples(), dtype=np.float32).reshape(-1, audio.channels)
+        frame_len = max(int(audio.frame_rate * frame_ms / 1000), 1)
+        n_frames = len(samples) // frame_len
+        if n_frames == 0:
+            return audio
+        frames = samples[:n_frames * frame_len].reshape(n_frames, -1)
+        rms = np.sqrt(np.mean(frames ** 2, axis=1)) / float(1 << (8 * audio.sample_width - 1))
+        db = 20 * np.log10(np.maximum(rms, 1e-10))
+        voiced = np.flatnonzero(db > max(db.max() - threshold_db, floor_db))
+        if len(voiced) == 0:
+            return audio
+        start = max(voiced[0] * frame_ms - padding_ms, 0)
+        end = min((voiced[-1] + 1) * frame_ms + padding_ms, len(audio))
+        return audio[start:end]
+
+    @property
+    def saved_bytes(self):
+        return self.source_bytes - self.size
+
+
+def wav_duration(wav_bytes):
+    with wave.open(BytesIO(wav_bytes), "rb") as wav:
+        return wav.getnframes() / wav.getframerate()
 
 
-def audio_to_base64(audio):
-    buf = BytesIO()
-    audio.export(buf, format="wav")
-    wav_bytes = buf.getvalue()
-    audio_base64 = base64.b64encode(wav_bytes).decode("utf-8")
-    return audio_base64
+def autoplay_html(audio_base64, delay_s=0.0):
+    if delay_s <= 0:
+        return f"""
+            <audio autoplay>
+              <source src="data:audio/wav;base64,{audio_base64}" type="audio/wav" />
+              Your browser does not support the audio element.
+            </audio>
+            """
+    return f"""
+        <audio id="response_audio">
+          <source src="data:audio/wav;base64,{audio_base64}" type="audio/wav" />
+          Your browser does not support the audio element.
+        </audio>
+        <script>
+          setTimeout(() => document.getElementById("response_audio").play(), {int(delay_s * 1000)});
+        </script>
+        """
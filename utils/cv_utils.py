@@ -1,23 +1,492 @@
+import av
+import bisect
 import cv2
 from PIL import Image
 import base64
+import copy
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from io import BytesIO
 import numpy as np
+import torch
+import yaml
 from ultralytics import YOLO, YOLOE
+from ultralytics.trackers.byte_tracker import BYTETracker
+from ultralytics.utils import IterableSimpleNamespace
+from ultralytics.utils.checks import check_yaml
 import streamlit as st
+from utils.storage_utils import FileLock
+
+
+INFERENCE_BACKENDS = ("torch", "onnx", "openvino")
+
+
+class TextEmbeddingCache:
+    def __init__(self, model, max_size=256):
+        self.model = model
+        self.max_size = max_size
+        self.embeddings = OrderedDict()
+
+    def get(self, class_names):
+        missing = [name for name in dict.fromkeys(class_names) if name not in self.embeddings]
+        if missing:
+            # encode only the words we have not seen, one column per class
+            text_pe = self.model.get_text_pe(missing)
+            for i, name in enumerate(missing):
+                self.embeddings[name] = text_pe[:, i:i + 1]
+        for name in class_names:
+            self.embeddings.move_to_end(name)
+        text_pe = torch.cat([self.embeddings[name] for name in class_names], dim=1)
+        while len(self.embeddings) > self.max_size:
+            self.embeddings.popitem(last=False)
+        return text_pe
+
+
+class Detections:
+    def __init__(self, xyxy, conf, cls, track_id=None, names=None):
+        self.xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        self.conf = np.asarray(conf, dtype=np.float32)
+        self.cls = np.asarray(cls, dtype=np.int32)
+        self.track_id = np.full(len(self.cls), -1, dtype=np.int32) if track_id is None \
+            else np.asarray(track_id, dtype=np.int32)
+        self.names = names or {}
+
+    @classmethod
+    def from_results(cls, result):
+        boxes = result.boxes
+        if boxes is None or len(boxes) == 0:
+            return cls(np.zeros((0, 4)), [], [], names=result.names)
+        # boxes.data is [x1, y1, x2, y2, (track_id), conf, cls]: one device-to-host copy per frame
+        data = boxes.data.cpu().numpy()
+        track_id = data[:, 4] if boxes.is_track else None
+        return cls(data[:, :4], data[:, -2], data[:, -1], track_id, result.names)
+
+    def __len__(self):
+        return len(self.cls)
+
+    def __getitem__(self, index):
+        return Detections(self.xyxy[index], self.conf[index], self.cls[index], self.track_id[index], self.names)
+
+    @property
+    def xywh(self):
+        xywh = self.xyxy.copy()
+        xywh[:, 2:] -= xywh[:, :2]
+        xywh[:, :2] += xywh[:, 2:] / 2
+        return xywh
+
+    @property
+    def class_names(self):
+        return [self.names[c] for c in self.cls.tolist()]
+
+
+class SessionTracker:
+    def __init__(self, tracker_config="bytetrack.yaml", frame_rate=30):
+        with open(check_yaml(tracker_config)) as f:
+            self.args = IterableSimpleNamespace(**yaml.safe_load(f))
+        self.frame_rate = frame_rate
+        self.tracker = BYTETracker(args=self.args, frame_rate=frame_rate)
+
+    def update(self, detections):
+        # rows are [x1, y1, x2, y2, track_id, score, cls, detection index]
+        tracks = self.tracker.update(detections)
+        if len(tracks) == 0:
+            return Detections(np.zeros((0, 4)), [], [], names=detections.names)
+        return Detections(tracks[:, :4], tracks[:, 5], tracks[:, 6], tracks[:, 4], detections.names)
+
+    def reset(self):
+        # BYTETracker.reset also zeroes the process-wide track id counter other sessions rely on
+        self.tracker = BYTETracker(args=self.args, frame_rate=self.frame_rate)
+
+
+class CompactMask:
+    def __init__(self, binary_mask, margin=16):
+        mask_h, mask_w = binary_mask.shape
+        rows = np.flatnonzero(binary_mask.any(axis=1))
+        cols = np.flatnonzero(binary_mask.any(axis=0))
+        if len(rows) == 0:
+            self.shape = (0, 0)
+            self.box = (0.0, 0.0, 0.0, 0.0)
+            self.bits = np.zeros(0, dtype=np.uint8)
+            return
+        # keep a margin around the object so the edge blur has room when it is drawn
+        y0, y1 = max(rows[0] - margin, 0), min(rows[-1] + 1 + margin, mask_h)
+        x0, x1 = max(cols[0] - margin, 0), min(cols[-1] + 1 + margin, mask_w)
+        crop = binary_mask[y0:y1, x0:x1]
+        self.shape = crop.shape
+        # crop box in normalised image coordinates, so it can be drawn at any frame size
+        self.box = (x0 / mask_w, y0 / mask_h, x1 / mask_w, y1 / mask_h)
+        self.bits = np.packbits(crop, axis=None)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def warp(self, scale, shift):
+        # moved copy sharing the packed bits; scale and shift act on normalised coordinates
+        warped = copy.copy(self)
+        x0, y0, x1, y1 = self.box
+        warped.box = (x0 * scale[0] + shift[0], y0 * scale[1] + shift[1],
+                      x1 * scale[0] + shift[0], y1 * scale[1] + shift[1])
+        return warped
+
+    def decode(self):
+        h, w = self.shape
+        return np.unpackbits(self.bits, count=h * w).reshape(h, w)
+
+    def render(self, frame_shape):
+        # returns the mask resized into its frame-space box, and that box
+        h, w = frame_shape[:2]
+        x0, y0 = int(round(self.box[0] * w)), int(round(self.box[1] * h))
+        x1, y1 = int(round(self.box[2] * w)), int(round(self.box[3] * h))
+        if self.shape[0] == 0 or x1 <= max(x0, 0) or y1 <= max(y0, 0) or x0 >= w or y0 >= h:
+            return None, None
+        mask = cv2.resize(self.decode().astype(np.float32), (x1 - x0, y1 - y0))
+        # a propagated mask may have drifted partly out of the frame
+        mask = mask[max(-y0, 0):mask.shape[0] - max(y1 - h, 0), max(-x0, 0):mask.shape[1] - max(x1 - w, 0)]
+        return mask, (max(x0, 0), max(y0, 0))
+
+
+class KeyframeScheduler:
+    def __init__(self, interval=10, scene_threshold=25.0, thumb_size=(64, 48)):
+        self.interval = interval
+        self.scene_threshold = scene_threshold
+        self.thumb_size = thumb_size
+        self.keyframe_thumb = None
+        self.classes = None
+        self.frames_since_keyframe = 0
+        self.keyframes = 0
+        self.propagated = 0
+
+    def update(self, frame, classes, allow_keyframe=True):
+        # returns whether to run YOLOE on this frame, and the global shift since the last keyframe
+        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        thumb = cv2.resize(gray, self.thumb_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+        if self.needs_keyframe(thumb, classes, allow_keyframe):
+            self.keyframe_thumb = thumb
+            self.classes = list(classes)
+            self.frames_since_keyframe = 0
+            self.keyframes += 1
+            return True, (0.0, 0.0)
+        self.frames_since_keyframe += 1
+        self.propagated += 1
+        (dx, dy), _ = cv2.phaseCorrelate(self.keyframe_thumb, thumb)
+        return False, (dx / self.thumb_size[0], dy / self.thumb_size[1])
+
+    def needs_keyframe(self, thumb, classes, allow_keyframe=True):
+        if self.keyframe_thumb is None or list(classes) != self.classes:
+            return True
+        if not allow_keyframe:
+            return False
+        if self.frames_since_keyframe + 1 >= self.interval:
+            return True
+        return float(np.mean(np.abs(thumb - self.keyframe_thumb))) > self.scene_threshold
+
+    def reset(self):
+        self.keyframe_thumb = None
+        self.classes = None
+        self.frames_since_keyframe = 0
+
+
+def box_iou(box, boxes):
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return inter / np.maximum(area + areas - inter, 1e-6)
+
+
+def bind_tracks(seg_results, detections, min_iou=0.3):
+    # attach the ByteTrack id of the best-overlapping detection to each keyframe mask
+    tracked = detections[detections.track_id >= 0] if detections is not None else None
+    for r in seg_results or []:
+        r["track_id"] = -1
+        if tracked is None or len(tracked) == 0:
+            continue
+        ious = box_iou(np.asarray(r["bbox"], dtype=np.float32), tracked.xyxy)
+        best = int(np.argmax(ious))
+        if ious[best] >= min_iou:
+            r["track_id"] = int(tracked.track_id[best])
+            r["track_box"] = tracked.xyxy[best].tolist()
+    return seg_results
+
+
+def propagate_segmentation(seg_results, detections, global_shift, frame_shape):
+    h, w = frame_shape[:2]
+    boxes_by_id = {}
+    if detections is not None:
+        boxes_by_id = dict(zip(detections.track_id.tolist(), detections.xyxy.tolist()))
+    propagated = []
+    for r in seg_results or []:
+        box = boxes_by_id.get(r.get("track_id", -1))
+        if box is not None:
+            # follow the tracked box: scale and move the mask with it
+            kx1, ky1, kx2, ky2 = r["track_box"]
+            sx = (box[2] - box[0]) / max(kx2 - kx1, 1.0)
+            sy = (box[3] - box[1]) / max(ky2 - ky1, 1.0)
+            scale = (sx, sy)
+            shift = ((box[0] - kx1 * sx) / w, (box[1] - ky1 * sy) / h)
+        else:
+            # untracked objects move with the camera
+            scale = (1.0, 1.0)
+            shift = global_shift
+        moved = dict(r)
+        moved["mask"] = r["mask"].warp(scale, shift)
+        x1, y1, x2, y2 = r["bbox"]
+        moved["bbox"] = [int(x1 * scale[0] + shift[0] * w), int(y1 * scale[1] + shift[1] * h),
+                         int(x2 * scale[0] + shift[0] * w), int(y2 * scale[1] + shift[1] * h)]
+        propagated.append(moved)
+    return propagated
+
+
+def fit_memory_budget(results, budget_bytes):
+    # keep the most confident masks that fit in the per-session budget
+    if not results:
+        return results
+    kept, used = [], 0
+    for r in sorted(results, key=lambda r: r["confidence"], reverse=True):
+        if used + r["mask"].nbytes > budget_bytes:
+            continue
+        kept.append(r)
+        used += r["mask"].nbytes
+    return kept
+
+
+# typical height in metres of every COCO class (longest side for objects usually seen lying down)
+OBJECT_HEIGHTS = {
+    "person": 1.7, "bicycle": 1.1, "car": 1.5, "motorcycle": 1.2, "airplane": 4.0, "bus": 3.0, "train": 3.5,
+    "truck": 3.0, "boat": 1.5, "traffic light": 0.9, "fire hydrant": 0.8, "stop sign": 0.75, "parking meter": 1.4,
+    "bench": 0.9, "bird": 0.25, "cat": 0.3, "dog": 0.6, "horse": 1.6, "sheep": 0.9, "cow": 1.4, "elephant": 3.0,
+    "bear": 1.2, "zebra": 1.4, "giraffe": 5.0, "backpack": 0.5, "umbrella": 1.0, "handbag": 0.3, "tie": 0.5,
+    "suitcase": 0.6, "frisbee": 0.25, "skis": 1.7, "snowboard": 1.5, "sports ball": 0.22, "kite": 1.0,
+    "baseball bat": 0.85, "baseball glove": 0.3, "skateboard": 0.8, "surfboard": 2.0, "tennis racket": 0.68,
+    "bottle": 0.25, "wine glass": 0.2, "cup": 0.1, "fork": 0.19, "knife": 0.22, "spoon": 0.17, "bowl": 0.08,
+    "banana": 0.2, "apple": 0.08, "sandwich": 0.1, "orange": 0.08, "broccoli": 0.15, "carrot": 0.18,
+    "hot dog": 0.15, "pizza": 0.3, "donut": 0.1, "cake": 0.15, "chair": 0.9, "couch": 0.9, "potted plant": 0.8,
+    "bed": 0.6, "dining table": 0.75, "toilet": 0.75, "tv": 0.6, "laptop": 0.25, "mouse": 0.1, "remote": 0.18,
+    "keyboard": 0.15, "cell phone": 0.15, "microwave": 0.3, "oven": 0.9, "toaster": 0.2, "sink": 0.2,
+    "refrigerator": 1.8, "book": 0.22, "clock": 0.3, "vase": 0.3, "scissors": 0.18, "teddy bear": 0.35,
+    "hair drier": 0.25, "toothbrush": 0.19
+}
+
+
+class TrackHistory:
+    def __init__(self, max_age_s=2.0, window_s=1.0, hfov_deg=70.0, vfov_deg=55.0):
+        self.max_age_s = max_age_s
+        self.window_s = window_s
+        self.hfov_deg = hfov_deg
+        self.vfov_deg = vfov_deg
+        self.tracks = {}
+
+    def update(self, detections, frame_shape, timestamp):
+        h, w = frame_shape[:2]
+        for (x1, y1, x2, y2), track_id in zip(detections.xyxy.tolist(), detections.track_id.tolist()):
+            if track_id < 0:
+                continue
+            samples = self.tracks.setdefault(track_id, [])
+            samples.append((timestamp, (x1 + x2) / (2 * w), (y2 - y1) / h))
+            while samples[0][0] < timestamp - self.window_s:
+                samples.pop(0)
+        for track_id in [i for i, samples in self.tracks.items() if samples[-1][0] < timestamp - self.max_age_s]:
+            del self.tracks[track_id]
+
+    def clock_direction(self, cx):
+        # the image centre is the user's heading (12 o'clock); one hour is 30 degrees
+        hour = int(round((cx - 0.5) * self.hfov_deg / 30)) % 12
+        return 12 if hour == 0 else hour
+
+    def distance(self, class_name, box_height):
+        focal = 0.5 / np.tan(np.radians(self.vfov_deg) / 2)
+        # without a known real size the box height says nothing about range, so no distance is given
+        if class_name not in OBJECT_HEIGHTS:
+            return None
+        return OBJECT_HEIGHTS[class_name] * focal / max(box_height, 1e-3)
+
+    def motion(self, track_id):
+        samples = self.tracks.get(track_id, [])
+        if len(samples) < 3 or samples[-1][0] - samples[0][0] < 0.3:
+            return None
+        (t0, cx0, h0), (t1, cx1, h1) = samples[0], samples[-1]
+        growth = (h1 / max(h0, 1e-3) - 1) / (t1 - t0)
+        drift = (cx1 - cx0) / (t1 - t0)
+        if growth > 0.15:
+            return "approaching"
+        if growth < -0.15:
+            return "moving away"
+        if abs(drift) > 0.1:
+            return "crossing to the right" if drift > 0 else "crossing to the left"
+        return "not moving"
+
+    def describe(self, detections, frame_shape, max_objects=12):
+        h, w = frame_shape[:2]
+        objects = []
+        for (x1, y1, x2, y2), name, conf, track_id in zip(detections.xyxy.tolist(), detections.class_names,
+                                                          detections.conf.tolist(), detections.track_id.tolist()):
+            objects.append({
+                "class_name": name,
+                "clock": self.clock_direction((x1 + x2) / (2 * w)),
+                "distance_m": self.distance(name, (y2 - y1) / h),
+                "motion": self.motion(track_id) if track_id >= 0 else None,
+                "confidence": conf
+            })
+        # nearest first: those are the ones a navigation answer is about
+        return sorted(objects, key=lambda o: (o["distance_m"] is None, o["distance_m"] or 0))[:max_objects]
+
+
+def format_scene(objects):
+    if not objects:
+        return "No objects detected."
+    lines = []
+    for o in objects:
+        motion = f", {o['motion']}" if o["motion"] else ""
+        distance = f", about {max(o['distance_m'], 1):.0f} m" if o["distance_m"] is not None else ""
+        lines.append(f"- {o['class_name']}: {o['clock']} o'clock{distance}{motion}")
+    return "\n".join(lines)
+
+
+class SegmentationOverlay:
+    def __init__(self, results, frame_shape, threshold, blur_size=31):
+        h, w = frame_shape[:2]
+        rgb = np.zeros((h, w, 3), dtype=np.uint8)
+        alpha = np.zeros((h, w), dtype=np.uint8)
+        for r in results:
+            color, text_color = r['color']
+            mask, offset = r['mask'].render(frame_shape)
+            if mask is not None:
+                mask = cv2.GaussianBlur(mask, (blur_size, blur_size), 0)
+                mask_bool = mask > threshold
+                mask_h, mask_w = mask.shape
+                region = (slice(offset[1], offset[1] + mask_h), slice(offset[0], offset[0] + mask_w))
+                rgb[region][mask_bool] = color
+                alpha[region][mask_bool] = 128
+
+                border_mask = mask_bool.astype(np.uint8) * 255
+                contours, _ = cv2.findContours(border_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                               offset=offset)
+                cv2.drawContours(rgb, contours, -1, (255, 255, 255), 3)
+                cv2.drawContours(alpha, contours, -1, 255, 3)
+
+            x1, y1, x2, y2 = r['bbox']
+            label = r['class_name']
+            (label_width, label_height), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+            cv2.rectangle(rgb, (x1, y1), (x1 + label_width, y1 + label_height + 4), color, -1)
+            cv2.rectangle(alpha, (x1, y1), (x1 + label_width, y1 + label_height + 4), 255, -1)
+            cv2.putText(rgb, label, (x1, y1 + label_height), cv2.FONT_HERSHEY_SIMPLEX, 0.5, text_color, 1)
+
+        # keep only the region that is actually drawn on, so compositing touches as few pixels as possible
+        ys, xs = np.nonzero(alpha)
+        if len(ys) == 0:
+            self.region = None
+            return
+        y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+        self.region = (slice(y0, y1), slice(x0, x1))
+        region_alpha = alpha[self.region][..., None].astype(np.uint16)
+        # premultiplied colour and inverse alpha, kept as uint8 to hold the cache small
+        self.rgb = ((rgb[self.region] * region_alpha + 127) // 255).astype(np.uint8)
+        self.inv_alpha = (255 - region_alpha).astype(np.uint8)
+
+    @property
+    def nbytes(self):
+        return 0 if self.region is None else self.rgb.nbytes + self.inv_alpha.nbytes
+
+    def apply(self, img):
+        if self.region is None:
+            return img
+        region = img[self.region].astype(np.uint16)
+        blended = (region * self.inv_alpha + 127) // 255 + self.rgb
+        img[self.region] = np.minimum(blended, 255).astype(np.uint8)
+        return img
+
+
+class ExportedModelCache:
+    def __init__(self, backend, int8=False, imgsz=640):
+        if backend not in INFERENCE_BACKENDS[1:]:
+            raise ValueError(f"Unsupported export backend: {backend}")
+        self.backend = backend
+        self.int8 = int8
+        self.imgsz = imgsz
+
+    def artifact_path(self, weights, tag=""):
+        # exported artifacts live next to the weights fetched by load_model_weights
+        stem = os.path.splitext(weights)[0] + (f"_{tag}" if tag else "") + ("_int8" if self.int8 else "")
+        return f"{stem}.onnx" if self.backend == "onnx" else f"{stem}_openvino_model"
+
+    def export(self, weights, load_model, tag=""):
+        target = self.artifact_path(weights, tag)
+        if os.path.exists(target):
+            return target
+        # several app workers may start at once; only one of them exports
+        with FileLock(target + ".lock"):
+            if os.path.exists(target):
+                return target
+            # ultralytics writes next to the weights it loaded, so each export works on its own copy
+            workdir = tempfile.mkdtemp(prefix=".export_", dir=os.path.dirname(os.path.abspath(target)))
+            try:
+                local_weights = os.path.join(workdir, os.path.basename(weights))
+                shutil.copy2(weights, local_weights)
+                model = load_model(local_weights)
+                exported = model.export(format=self.backend, imgsz=self.imgsz, dynamic=True,
+                                        int8=self.int8 and self.backend == "openvino", verbose=False)
+                if self.int8 and self.backend == "onnx":
+                    try:
+                        from onnxruntime.quantization import quantize_dynamic, QuantType
+                    except ImportError:
+                        raise RuntimeError("INT8 ONNX export needs onnxruntime: pip install -r requirements-export.txt")
+                    quantized = os.path.join(workdir, os.path.basename(target))
+                    quantize_dynamic(exported, quantized, weight_type=QuantType.QInt8)
+                    exported = quantized
+                os.replace(exported, target)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+        return target
 
 
 class YOLOModel:
-    def __init__(self, weights):
-        self.yolo_model = YOLO(weights["yolo_model"])
-        self.yoloe_model_name = weights["yoloe_model"]
-        self.tracker = "bytetrack.yaml"
+    def __init__(self, weights, backend="torch", int8=False, yoloe_classes=()):
         self.conf = 0.25
         self.yoloe_thr = 0.25
         self.imgsz = 640
+        self.backend = backend
+        self.exports = ExportedModelCache(backend, int8, self.imgsz) if backend != "torch" else None
+        self.yolo_model_name = weights["yolo_model"]
+        self.yolo_model = YOLO(self.yolo_model_name)
+        if self.exports is not None:
+            self.yolo_model_name = self.exports.export(self.yolo_model_name, YOLO)
+            self.yolo_model = YOLO(self.yolo_model_name, task="detect")
+        self.yoloe_model_name = weights["yoloe_model"]
+        self.yoloe_model = YOLOE(self.yoloe_model_name)
+        self.yoloe_lock = threading.Lock()
+        self.yoloe_classes = None
+        self.text_embeddings = TextEmbeddingCache(self.yoloe_model)
+        self.exported_yoloe = None
+        self.exported_yoloe_classes = list(yoloe_classes)
+        if self.exports is not None and self.exported_yoloe_classes:
+            self.exported_yoloe = YOLO(self.export_yoloe(self.exported_yoloe_classes), task="segment")
+        self.tracker_config = "bytetrack.yaml"
+        self.predict_lock = threading.Lock()
         self.classes = self.yolo_model.names
         self.colors = self.generate_colors()
 
+    def export_yoloe(self, class_names):
+        # an exported YOLOE graph has its vocabulary baked in, so one configured class set is exported up front
+        text_pe = self.text_embeddings.get(class_names)
+
+        def load_model(path):
+            model = YOLOE(path)
+            model.set_classes(class_names, text_pe)
+            return model
+
+        tag = hashlib.sha1("\n".join(class_names).encode("utf-8")).hexdigest()[:12]
+        return self.exports.export(self.yoloe_model_name, load_model, tag)
+
     def generate_colors(self, num_classes=None):
         color_pairs = []
         if num_classes is not None and num_classes <= 8:
@@ -46,25 +515,25 @@ class YOLOModel:
             color_pairs.append((color, text_color))
         return color_pairs
 
-    def track(self, img_bgr):
-        kwargs = dict(
-            imgsz=self.imgsz,
-            conf=self.conf,
-            verbose=False
-        )
-        if self.tracker:
-            kwargs["tracker"] = self.tracker
-            kwargs["persist"] = True
-            return self.yolo_model.track(img_bgr, **kwargs)
-        else:
-            return self.yolo_model.predict(img_bgr, **kwargs)
+    def create_tracker(self):
+        return SessionTracker(self.tracker_config)
 
-    def draw_boxes(self, img, results):
-        for box in results.boxes:
+    def predict(self, img_bgr, imgsz=None):
+        # the weights are shared by every session; track state lives in each session's SessionTracker
+        with self.predict_lock:
+            results = self.yolo_model.predict(img_bgr, imgsz=imgsz or self.imgsz, conf=self.conf, verbose=False)
+        return Detections.from_results(results[0])
+
+    def detect(self, img_bgr, tracker=None, imgsz=None):
+        detections = self.predict(img_bgr, imgsz)
+        if tracker is not None:
+            detections = tracker.update(detections)
+        return detections
+
+    def draw_boxes(self, img, detections):
+        boxes = detections.xyxy.astype(int).tolist()
+        for (x1, y1, x2, y2), conf, cls in zip(boxes, detections.conf.tolist(), detections.cls.tolist()):
             # show bounding boxes
-            x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
-            conf = box.conf[0].cpu().numpy()
-            cls = int(box.cls[0].cpu().numpy())
             cls_name = self.yolo_model.names[cls]
             color, text_color = self.colors[cls]
             cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
@@ -75,79 +544,224 @@ class YOLOModel:
             cv2.putText(img, label, (x1, y1 + label_height), cv2.FONT_HERSHEY_SIMPLEX, 0.5, text_color, 1)
         return img
 
-    def run_yoloe(self, img, class_names):
+    def run_yoloe(self, img, class_names, imgsz=None):
         if not class_names:
             return None
-        yoloe_model = YOLOE(self.yoloe_model_name)
-        yoloe_model.set_classes(class_names, yoloe_model.get_text_pe(class_names))
-        results = yoloe_model.predict(img, imgsz=self.imgsz)
+        imgsz = imgsz or self.imgsz
+        class_ids = None
+        with self.yoloe_lock:
+            if self.exported_yoloe is not None and set(class_names) <= set(self.exported_yoloe_classes):
+                # the baked vocabulary covers the request: keep only the requested classes and renumber them
+                baked = self.exported_yoloe_classes
+                results = self.exported_yoloe.predict(img, imgsz=imgsz, verbose=False,
+                                                      classes=[baked.index(name) for name in class_names])
+                class_ids = {baked.index(name): i for i, name in enumerate(class_names)}
+            else:
+                self.set_yoloe_classes(class_names)
+                results = self.yoloe_model.predict(img, imgsz=imgsz)
         colors = self.generate_colors(len(class_names))
         segmentation_data = []
         for r in results:
             if r.boxes is not None and r.masks is not None:
-                boxes = r.boxes
-                masks = r.masks
-                for i in range(len(boxes)):
+                detections = Detections.from_results(r)
+                binary_masks = r.masks.data > self.yoloe_thr
+                mask_areas = binary_masks.sum(dim=(1, 2)).cpu().numpy()
+                binary_masks = binary_masks.cpu().numpy()
+                bboxes = detections.xyxy.astype(int).tolist()
+                for i, (class_id, conf) in enumerate(zip(detections.cls.tolist(), detections.conf.tolist())):
+                    if class_ids is not None:
+                        class_id = class_ids[class_id]
                     seg_info = {
-                        "class_id": int(boxes.cls[i].cpu().numpy()),
-                        "class_name": class_names[int(boxes.cls[i].cpu().numpy())],
-                        "confidence": float(boxes.conf[i].cpu().numpy()),
-                        "bbox": boxes.xyxy[i].cpu().numpy().astype(int).tolist(),
-                        "mask": masks.data[i].cpu().numpy(),
-                        "mask_area": np.sum(masks.data[i].cpu().numpy() > self.yoloe_thr)
+                        "class_id": class_id,
+                        "class_name": class_names[class_id],
+                        "confidence": conf,
+                        "bbox": bboxes[i],
+                        "mask": CompactMask(binary_masks[i]),
+                        "mask_area": int(mask_areas[i]),
+                        "color": colors[class_id]
                     }
-                    seg_info["color"] = colors[seg_info["class_id"]]
                     segmentation_data.append(seg_info)
         return segmentation_data
 
-    def draw_segmentation_on_image(self, img, results):
-        h, w = img.shape[:2]
-        for r in results:
-            mask = r['mask']
-            mask = cv2.resize(mask, (w, h))
-            mask = cv2.GaussianBlur(mask, (31, 31), 0)
-
-            x1, y1, x2, y2 = r['bbox']
-            label = r['class_name']
-            color, text_color = r['color']
-            # cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
+    def set_yoloe_classes(self, class_names):
+        class_names = list(class_names)
+        if class_names == self.yoloe_classes:
+            return
+        self.yoloe_model.set_classes(class_names, self.text_embeddings.get(class_names))
+        self.yoloe_classes = class_names
 
-            mask_bool = mask > self.yoloe_thr
-            mask_color = np.full_like(img[mask_bool], color)
-            img[mask_bool] = cv2.addWeighted(img[mask_bool], 0.5, mask_color, 0.5, 0)
+    def build_overlay(self, results, frame_shape):
+        return SegmentationOverlay(results, frame_shape, self.yoloe_thr)
 
-            border_mask = (mask_bool).astype(np.uint8) * 255
-            contours, _ = cv2.findContours(border_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            cv2.drawContours(img, contours, -1, (255, 255, 255), 3)
+    def draw_segmentation_on_image(self, img, results):
+        return self.build_overlay(results, img.shape).apply(img)
 
-            (label_width, label_height), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
-            cv2.rectangle(img, (x1, y1), (x1 + label_width, y1 + label_height + 4), color, -1)
-            cv2.putText(img, label, (x1, y1 + label_height), cv2.FONT_HERSHEY_SIMPLEX, 0.5, text_color, 1)
+    def render_segmentation(self, image, results):
+        img = np.array(image)
+        if results:
+            img = self.draw_segmentation_on_image(img, results)
         return img
 
 
 @st.cache_resource
-def create_yolo_model(weights):
-    return YOLOModel(weights)
+def create_yolo_model(weights, backend="torch", int8=False, yoloe_classes=()):
+    return YOLOModel(weights, backend, int8, yoloe_classes)
 
 
-def capture_frame(video_path, timestamp_s):
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        raise RuntimeError("Could not open video.")
+class VideoDecoder:
+    def __init__(self, video_path, max_forward_s=2.0):
+        self.video_path = video_path
+        self.file = None
+        self.mmap = None
+        if os.path.isfile(video_path):
+            # local cache files are read through a memory map instead of buffered reads
+            self.file = open(video_path, "rb")
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.container = av.open(self.mmap)
+        else:
+            self.container = av.open(video_path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        self.fps = float(self.stream.average_rate or 30)
+        self.max_forward_s = max_forward_s
+        self.keyframes = []
+        self.frames = None
+        self.position = None
+        self.lock = threading.Lock()
 
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_no = int(timestamp_s * fps)
+    def read(self, timestamp_s):
+        with self.lock:
+            if not self._can_decode_forward(timestamp_s):
+                self._seek(timestamp_s)
+            half_frame = 0.5 / self.fps
+            for frame in self.frames:
+                if frame.time is None:
+                    continue
+                if frame.key_frame:
+                    self._index_keyframe(frame.time)
+                self.position = frame.time
+                if frame.time + half_frame >= timestamp_s:
+                    return frame.to_ndarray(format="rgb24")
+            self.position = None
+        raise RuntimeError(f"Could not read frame at {timestamp_s:.2f}s.")
 
-    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
-    ret, frame = cap.read()
-    cap.release()
+    def _can_decode_forward(self, timestamp_s):
+        if self.position is None or timestamp_s <= self.position:
+            return False
+        if timestamp_s - self.position > self.max_forward_s:
+            return False
+        # a known keyframe between the decoder position and the target is a cheaper entry point
+        i = bisect.bisect_right(self.keyframes, self.position)
+        return i == len(self.keyframes) or self.keyframes[i] > timestamp_s
+
+    def _seek(self, timestamp_s):
+        i = bisect.bisect_right(self.keyframes, timestamp_s)
+        target_s = self.keyframes[i - 1] if i else timestamp_s
+        self.container.seek(int(target_s / self.stream.time_base), stream=self.stream, backward=True)
+        self.frames = self.container.decode(self.stream)
+        self.position = None
+
+    def _index_keyframe(self, time_s):
+        i = bisect.bisect_left(self.keyframes, time_s)
+        if i == len(self.keyframes) or self.keyframes[i] != time_s:
+            self.keyframes.insert(i, time_s)
+
+    def close(self):
+        with self.lock:
+            self.container.close()
+            if self.mmap is not None:
+                self.mmap.close()
+                self.file.close()
+
+
+class FrameCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.frames.move_to_end(key)
+            return frame
+
+    def put(self, key, frame):
+        frame.flags.writeable = False
+        with self.lock:
+            if key in self.frames:
+                self.size -= self.frames.pop(key).nbytes
+            self.frames[key] = frame
+            self.size += frame.nbytes
+            while self.size > self.max_bytes and len(self.frames) > 1:
+                _, evicted = self.frames.popitem(last=False)
+                self.size -= evicted.nbytes
+
+
+class DecoderPool:
+    def __init__(self, max_decoders=4, max_cached_bytes=256 * 1024 * 1024):
+        self.max_decoders = max_decoders
+        self.decoders = OrderedDict()
+        self.frames = FrameCache(max_cached_bytes)
+        self.lock = threading.Lock()
+
+    def get_frame(self, video_key, video_path, timestamp_s):
+        decoder = self.get_decoder(video_key, video_path)
+        frame_no = int(timestamp_s * decoder.fps)
+        frame = self.frames.get((video_key, frame_no))
+        if frame is not None:
+            return frame
+        try:
+            frame = decoder.read(frame_no / decoder.fps)
+        except (av.error.FFmpegError, RuntimeError):
+            # the remote stream may have expired or dropped; retry once on a fresh decoder
+            self.release(video_key)
+            decoder = self.get_decoder(video_key, video_path)
+            frame = decoder.read(frame_no / decoder.fps)
+        self.frames.put((video_key, frame_no), frame)
+        return frame
+
+    def get_decoder(self, video_key, video_path):
+        with self.lock:
+            decoder = self.decoders.get(video_key)
+            if decoder is not None:
+                # switch to the local copy once the blob cache has it
+                if decoder.mmap is not None or not os.path.isfile(video_path):
+                    self.decoders.move_to_end(video_key)
+                    return decoder
+                del self.decoders[video_key]
+                decoder.close()
+        try:
+            decoder = VideoDecoder(video_path)
+        except av.error.FFmpegError as e:
+            raise RuntimeError("Could not open video.") from e
+        with self.lock:
+            if video_key in self.decoders:
+                decoder.close()
+                return self.decoders[video_key]
+            self.decoders[video_key] = decoder
+            while len(self.decoders) > self.max_decoders:
+                _, evicted = self.decoders.popitem(last=False)
+                evicted.close()
+        return decoder
+
+    def release(self, video_key):
+        with self.lock:
+            decoder = self.decoders.pop(video_key, None)
+        if decoder is not None:
+            decoder.close()
 
-    if not ret:
-        raise RuntimeError(f"Could not read frame at {timestamp_s:.2f}s.")
 
-    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    return Image.fromarray(frame_rgb)
+@st.cache_resource
+def get_decoder_pool():
+    return DecoderPool()
+
+
+def capture_frame(video_path, timestamp_s, video_key=None):
+    frame = get_decoder_pool().get_frame(video_key or video_path, video_path, timestamp_s)
+    return Image.fromarray(frame)
 
 
 def image_to_base64(pil_image):
@@ -157,12 +771,69 @@ def image_to_base64(pil_image):
     return base64.b64encode(img_bytes).decode('utf-8')
 
 
-def image_to_bytes(img):
-    if isinstance(img, np.ndarray):
-        img = Image.fromarray(img)
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    return buffer.getvalue()
+def frame_dhash(img, hash_size=8):
+    # difference hash: one bit per horizontally adjacent pair of a tiny grayscale thumbnail
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else img
+    thumb = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (thumb[:, 1:] > thumb[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+IMAGE_MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+class PreparedImage:
+    def __init__(self, img, fmt="jpeg", quality=85, max_side=1024, roi=None):
+        if fmt not in IMAGE_MIME_TYPES:
+            raise ValueError(f"Unsupported image format: {fmt}")
+        if isinstance(img, Image.Image):
+            img = np.asarray(img.convert("RGB"))
+        self.source_shape = img.shape
+        self.fmt = fmt
+        self.quality = quality
+        self.mime_type = IMAGE_MIME_TYPES[fmt]
+        start = time.perf_counter()
+        img = self.crop(img, roi)
+        self.dhash = frame_dhash(img)
+        img = self.resize(img, max_side)
+        self.shape = img.shape
+        # encoded once per question, so retries and fallbacks resend the same bytes
+        self.data = self.encode(img)
+        self.encode_ms = 1000 * (time.perf_counter() - start)
+
+    @staticmethod
+    def crop(img, roi):
+        # roi keeps that fraction of each side around the centre, which the prompt treats as the viewpoint
+        if not roi or roi >= 1:
+            return img
+        h, w = img.shape[:2]
+        ch, cw = int(round(h * roi)), int(round(w * roi))
+        y0, x0 = (h - ch) // 2, (w - cw) // 2
+        return img[y0:y0 + ch, x0:x0 + cw]
+
+    @staticmethod
+    def resize(img, max_side):
+        h, w = img.shape[:2]
+        if not max_side or max(h, w) <= max_side:
+            return img
+        scale = max_side / max(h, w)
+        return cv2.resize(img, (int(round(w * scale)), int(round(h * scale))), interpolation=cv2.INTER_AREA)
+
+    def encode(self, img):
+        if self.fmt == "jpeg":
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        elif self.fmt == "webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        else:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+        ok, buffer = cv2.imencode(f".{self.fmt}", cv2.cvtColor(img, cv2.COLOR_RGB2BGR), params)
+        if not ok:
+            raise RuntimeError(f"Could not encode image as {self.fmt}")
+        return buffer.tobytes()
+
+    @property
+    def size(self):
+        return len(self.data)
 
 
 def parse_timestamp(tms):
@@ -0,0 +1,184 @@
+import itertools
+import multiprocessing as mp
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+import numpy as np
+import streamlit as st
+from utils.cv_utils import Detections
+
+
+def attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13 attaching also registers the block, but spawned workers share the
+        # server's resource tracker, so the owning session's unlink still clears it exactly once
+        return shared_memory.SharedMemory(name=name)
+
+
+def inference_worker(weights, imgsz, conf, requests, responses):
+    from ultralytics import YOLO
+    model = YOLO(weights, task="detect")
+    while True:
+        batch = requests.get()
+        if batch is None:
+            break
+        handles, frames, sizes = [], [], {}
+        try:
+            for i, (_, shm_name, shape, size) in enumerate(batch):
+                handles.append(attach_shared_memory(shm_name))
+                frames.append(np.ndarray(shape, dtype=np.uint8, buffer=handles[-1].buf))
+                sizes.setdefault(size or imgsz, []).append(i)
+            # one forward pass per input size for the frames of every session in the batch
+            outputs = [None] * len(batch)
+            for size, indices in sizes.items():
+                results = model.predict([frames[i] for i in indices], imgsz=size, conf=conf, verbose=False)
+                for i, r in zip(indices, results):
+                    outputs[i] = (batch[i][0], r.boxes.data.cpu().numpy(), None)
+        except Exception as e:
+            outputs = [(request[0], None, repr(e)) for request in batch]
+        del frames
+        for shm in handles:
+            shm.close()
+        responses.put(outputs)
+
+
+class InferenceService:
+    def __init__(self, weights, names, num_workers=2, max_batch=8, max_wait_ms=5, imgsz=640, conf=0.25):
+        self.names = names
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.frames = 0
+        self.futures = {}
+        self.request_ids = itertools.count()
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+
+        context = mp.get_context("spawn")
+        self.requests = context.Queue()
+        self.responses = context.Queue()
+        self.workers = [
+            context.Process(target=inference_worker, args=(weights, imgsz, conf, self.requests, self.responses),
+                            daemon=True)
+            for _ in range(num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        self.batch_thread = threading.Thread(target=self._batch_loop, daemon=True)
+        self.collect_thread = threading.Thread(target=self._collect_loop, daemon=True)
+        self.batch_thread.start()
+        self.collect_thread.start()
+
+    def submit(self, shm_name, shape, imgsz=None):
+        future = Future()
+        request_id = next(self.request_ids)
+        with self.lock:
+            self.futures[request_id] = future
+        self.pending.put((request_id, shm_name, tuple(shape), imgsz))
+        return future
+
+    def _batch_loop(self):
+        while True:
+            request = self.pending.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = time.monotonic() + self.max_wait
+            # wait briefly for frames from other sessions to share the forward pass
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.pending.put(None)
+                    break
+                batch.append(request)
+            self.requests.put(batch)
+            self.batches += 1
+            self.frames += len(batch)
+
+    def _collect_loop(self):
+        while True:
+            outputs = self.responses.get()
+            if outputs is None:
+                break
+            for request_id, data, error in outputs:
+                with self.lock:
+                    future = self.futures.pop(request_id, None)
+                if future is None:
+                    continue
+                if error is not None:
+                    future.set_exception(RuntimeError(f"Inference worker error: {error}"))
+                else:
+                    future.set_result(data)
+
+    def stats(self):
+        return {
+            "workers": len(self.workers),
+            "batches": self.batches,
+            "frames": self.frames,
+            "mean_batch_size": self.frames / self.batches if self.batches else 0.0
+        }
+
+    def close(self):
+        self.pending.put(None)
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+        self.responses.put(None)
+        self.collect_thread.join(timeout=5)
+
+
+class InferenceClient:
+    def __init__(self, service, timeout=5.0):
+        self.service = service
+        self.timeout = timeout
+        self.shm = None
+        self.shape = None
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def detect(self, frame, imgsz=None):
+        with self.lock:
+            # a detection still in flight when the session ends must not allocate a block nobody unlinks
+            if self.closed:
+                raise RuntimeError("Inference client is closed")
+            if self.shm is None or self.shape != frame.shape:
+                self._allocate(frame.shape)
+            # the only copy: into the session's shared block, which the workers read in place
+            np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)[:] = frame
+            shm_name, shape = self.shm.name, self.shape
+        data = self.service.submit(shm_name, shape, imgsz).result(timeout=self.timeout)
+        return Detections(data[:, :4], data[:, -2], data[:, -1], names=self.service.names)
+
+    def _allocate(self, shape):
+        self._unlink()
+        self.shape = shape
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+
+    def _unlink(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def close(self):
+        # called from the processor's on_ended; the block would otherwise stay in /dev/shm until the server exits
+        with self.lock:
+            self.closed = True
+            self._unlink()
+
+
+@st.cache_resource
+def get_inference_service(_yolo_model, num_workers):
+    return InferenceService(_yolo_model.yolo_model_name, _yolo_model.classes, num_workers=num_workers,
+                            imgsz=_yolo_model.imgsz, conf=_yolo_model.conf)
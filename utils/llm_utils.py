@@ -1,49 +1,368 @@
-from google import genai
-from google.genai import types
+import aiohttp
+import httpx
+from google.genai import errors, types
 from utils.prompts import get_prompt
+from utils.resource_utils import get_genai_client
+from utils.async_utils import ResilientCaller, get_background_loop, get_retry_budget, get_latency_tracker
 import json
 import re
 import ast
+import threading
+import time
+from collections import OrderedDict
+import streamlit as st
+
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+RESPONSE_START = re.compile(r'"response"\s*:\s*"')
+OBJECTS_LIST = re.compile(r'"search_objects"\s*:\s*(\[.*?])', re.DOTALL)
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', '\\': '\\', '/': '/'}
+
+
+class StreamingResponseParser:
+    def __init__(self):
+        self.buffer = ""
+        self.objects = None
+        self.response_pos = None
+        self.response_done = False
+        self.pending_text = ""
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        events = []
+        if self.objects is None:
+            objects_match = OBJECTS_LIST.search(self.buffer)
+            if objects_match:
+                is_list, objects = parse_list(objects_match.group(1))
+                if is_list:
+                    self.objects = objects
+                    events.append(("search_objects", objects))
+        if not self.response_done:
+            events.extend(self._scan_response())
+        return events
+
+    def close(self):
+        events = []
+        if not self.response_done and self.pending_text.strip():
+            events.append(("sentence", self.pending_text.strip()))
+        self.pending_text = ""
+        self.response_done = True
+        return events
+
+    def _scan_response(self):
+        if self.response_pos is None:
+            start_match = RESPONSE_START.search(self.buffer)
+            if not start_match:
+                return []
+            self.response_pos = start_match.end()
+        pos = self.response_pos
+        while pos < len(self.buffer):
+            char = self.buffer[pos]
+            if char == '"':
+                self.response_done = True
+                pos += 1
+                break
+            if char == '\\':
+                # wait for the rest of a split escape sequence
+                if pos + 1 >= len(self.buffer):
+                    break
+                code = self.buffer[pos + 1]
+                if code == 'u':
+                    decoded = self._unicode_escape(pos)
+                    if decoded is None:
+                        break
+                    char, pos = decoded
+                else:
+                    char = ESCAPES.get(code, code)
+                    pos += 2
+            else:
+                pos += 1
+            self.pending_text += char
+        self.response_pos = pos
+        return self._split_sentences()
+
+    def _unicode_escape(self, pos):
+        # returns (char, next_pos), or None while the escape (or the second half of a pair) is incomplete
+        if pos + 6 > len(self.buffer):
+            return None
+        try:
+            code = int(self.buffer[pos + 2:pos + 6], 16)
+        except ValueError:
+            return self.buffer[pos:pos + 6], pos + 6
+        if 0xDC00 <= code <= 0xDFFF:
+            return "\ufffd", pos + 6
+        if not 0xD800 <= code <= 0xDBFF:
+            return chr(code), pos + 6
+        # characters outside the BMP (e.g. emoji) arrive as a high and a low surrogate escape
+        low = self.buffer[pos + 6:pos + 12]
+        if len(low) < 6 and "\\u".startswith(low[:2]):
+            return None
+        try:
+            low_code = int(low[2:], 16) if low.startswith("\\u") else None
+        except ValueError:
+            low_code = None
+        if low_code is None or not 0xDC00 <= low_code <= 0xDFFF:
+            return "\ufffd", pos + 6
+        return chr(0x10000 + ((code - 0xD800) << 10) + (low_code - 0xDC00)), pos + 12
+
+    def _split_sentences(self):
+        events = []
+        while True:
+            sentence_match = SENTENCE_END.search(self.pending_text)
+            if not sentence_match:
+                break
+            sentence = self.pending_text[:sentence_match.start()].strip()
+            self.pending_text = self.pending_text[sentence_match.end():]
+            if sentence:
+                events.append(("sentence", sentence))
+        if self.response_done:
+            if self.pending_text.strip():
+                events.append(("sentence", self.pending_text.strip()))
+            self.pending_text = ""
+        return events
+
+
+def parse_list(s):
+    try:
+        s_eval = ast.literal_eval(s)
+        is_list = isinstance(s_eval, list)
+        list_processed = [str(s) for s in s_eval] if is_list else []
+        return is_list, list_processed
+    except:
+        return False, []
+
+
+class PromptCache:
+    def __init__(self, client, ttl=3600, refresh_margin=300, retry_after=600, timeout=10):
+        self.client = client
+        self.ttl = ttl
+        # the lock is held across the API call, so a hung call must not stall every session
+        self.http_options = types.HttpOptions(timeout=int(timeout * 1000))
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.handles = {}
+        self.failed = {}
+        self.created = 0
+        self.refreshed = 0
+        self.deleted = 0
+        self.errors = 0
+
+    def get(self, model_name, language, prompt):
+        # returns the name of a server-side cache holding the prompt, or None to send it inline instead
+        key = (model_name, language)
+        now = time.monotonic()
+        with self.lock:
+            if now < self.failed.get(key, 0):
+                return None
+            handle = self.handles.get(key)
+            if handle is not None and now < handle["expires"] - self.refresh_margin:
+                return handle["name"]
+            try:
+                if handle is not None and now < handle["expires"]:
+                    self.client.caches.update(name=handle["name"],
+                                              config=types.UpdateCachedContentConfig(ttl=f"{self.ttl}s",
+                                                                                    http_options=self.http_options))
+                    self.refreshed += 1
+                else:
+                    cache = self.client.caches.create(
+                        model=model_name,
+                        config=types.CreateCachedContentConfig(
+                            display_name=f"morph-prompt-{language}",
+                            system_instruction=prompt,
+                            ttl=f"{self.ttl}s",
+                            http_options=self.http_options
+                        )
+                    )
+                    handle = {"name": cache.name}
+                    self.handles[key] = handle
+                    self.created += 1
+                handle["expires"] = now + self.ttl
+                return handle["name"]
+            except (errors.APIError, httpx.TransportError):
+                # e.g. the prompt is below the model's minimum cacheable size; don't retry on every question
+                self.errors += 1
+                self.failed[key] = now + self.retry_after
+                dropped = self.handles.pop(key, None)
+        if dropped is not None:
+            self.delete(dropped["name"])
+        return None
+
+    def invalidate(self, model_name, language):
+        with self.lock:
+            dropped = self.handles.pop((model_name, language), None)
+        if dropped is not None:
+            self.delete(dropped["name"])
+
+    def delete(self, name):
+        # cached contents are billed per hour until their TTL runs out, so a dropped handle is deleted
+        try:
+            self.client.caches.delete(name=name, config=types.DeleteCachedContentConfig(http_options=self.http_options))
+            self.deleted += 1
+        except (errors.APIError, httpx.TransportError):
+            pass
+
+    def stats(self):
+        return {
+            "caches": len(self.handles),
+            "created": self.created,
+            "refreshed": self.refreshed,
+            "deleted": self.deleted,
+            "errors": self.errors
+        }
+
+
+@st.cache_resource
+def get_prompt_cache(api_key):
+    return PromptCache(get_genai_client(api_key))
+
+
+def is_cache_miss(error):
+    # an expired or deleted cached content is reported as not found or, for some keys, permission denied
+    return isinstance(error, errors.ClientError) and error.code in (403, 404)
+
+
+def is_retryable(error):
+    if isinstance(error, errors.ClientError):
+        return error.code == 429
+    # with aiohttp installed the async client sends requests through it instead of httpx
+    return isinstance(error, (errors.ServerError, httpx.TransportError, aiohttp.ClientError))
 
 
 class LLM:
-    def __init__(self, session):
+    def __init__(self, session, client=None, prompt_cache=None, timeout=30, first_chunk_timeout=10,
+                 stream_timeout=60, max_retries=2, hedge=True):
         self.key = session["secrets"]["GEMINI_KEY"]
-        self.client = genai.Client(api_key=self.key)
+        self.client = client or get_genai_client(self.key)
+        self.prompt_cache = prompt_cache or get_prompt_cache(self.key)
         self.model_name = session["model_name"]
         self.language = session["language"]
         self.prompt = get_prompt(self.language)
+        self.timeout = timeout
+        self.first_chunk_timeout = first_chunk_timeout
+        self.stream_timeout = stream_timeout
+        self.loop = get_background_loop()
+        # full answers and time to first chunk have very different latencies, so each keeps its own p95
+        self.caller = ResilientCaller(get_retry_budget(), get_latency_tracker(self.model_name, "full"),
+                                      max_retries=max_retries, retryable=is_retryable, hedge=hedge)
+        self.stream_caller = ResilientCaller(get_retry_budget(), get_latency_tracker(self.model_name, "stream"),
+                                             max_retries=max_retries, retryable=is_retryable, hedge=hedge)
 
     def response(self, contents, generation_config):
-        response = self.client.models.generate_content(
-            model=self.model_name,
-            contents=contents,
-            config=generation_config
-        )
+        # the script thread waits at most `timeout`; retries and hedges happen inside that deadline
+        def make_call():
+            return self.client.aio.models.generate_content(
+                model=self.model_name,
+                contents=contents,
+                config=generation_config
+            )
+
+        response = self.loop.run(self.caller.call(make_call, self.timeout), timeout=self.timeout + 1)
         return response.text.strip()
 
-    def get_full_response(self, image_data, audio_base64):
-        full_prompt = f"""
-                    {self.prompt}
-                    Response to user question (audio) based on the image provided.
-                """
-        contents = [
-            types.Content(
-                parts=[
-                    types.Part(text=full_prompt),
-                    types.Part(inline_data=types.Blob(mime_type="image/png", data=image_data)),
-                    types.Part(inline_data=types.Blob(mime_type="audio/wav", data=audio_base64))
-                ]
-            )
-        ]
-        generation_config = types.GenerateContentConfig(
-            temperature=0,
-            # thinking_config=types.ThinkingConfig(thinking_budget=0)
-        )
-        response = self.response(contents, generation_config)
+    def build_request(self, image, audio, scene=None, use_cache=True):
+        # only the question is sent per request; the static prompt is a cached context or system instruction
+        parts = []
+        if scene is not None:
+            source = "the image provided and the objects" if image is not None else "the objects"
+            parts.append(types.Part(text=f"""Response to user question (audio) based on {source} an on-device detector
+                    found in the user's view (direction as clock position, rough distance, motion):
+                    {scene}"""))
+        else:
+            parts.append(types.Part(text="Response to user question (audio) based on the image provided."))
+        if image is not None:
+            parts.append(types.Part(inline_data=types.Blob(mime_type=image.mime_type, data=image.data)))
+        parts.append(types.Part(inline_data=types.Blob(mime_type=audio.mime_type, data=audio.data)))
+        contents = [types.Content(role="user", parts=parts)]
+        cache_name = self.prompt_cache.get(self.model_name, self.language, self.prompt) if use_cache else None
+        if cache_name:
+            generation_config = types.GenerateContentConfig(temperature=0, cached_content=cache_name)
+        else:
+            generation_config = types.GenerateContentConfig(temperature=0, system_instruction=self.prompt)
+        return contents, generation_config
+
+    def uses_cache(self, generation_config):
+        return generation_config.cached_content is not None
+
+    def get_full_response(self, image, audio, scene=None):
+        contents, generation_config = self.build_request(image, audio, scene)
+        try:
+            response = self.response(contents, generation_config)
+        except errors.ClientError as e:
+            if not self.uses_cache(generation_config) or not is_cache_miss(e):
+                raise
+            # the cache has expired or was deleted on the server; answer with the inline prompt
+            self.prompt_cache.invalidate(self.model_name, self.language)
+            contents, generation_config = self.build_request(image, audio, scene, use_cache=False)
+            response = self.response(contents, generation_config)
         output = self._parse_response(response)
         return output
 
+    def open_first_chunk(self, contents, generation_config):
+        # retries and hedges race the time to first chunk; the winning stream is handed back still open
+        async def make_call():
+            stream = await self.client.aio.models.generate_content_stream(
+                model=self.model_name,
+                contents=contents,
+                config=generation_config
+            )
+            try:
+                return stream, await stream.__anext__()
+            except StopAsyncIteration:
+                return None, None
+            except BaseException:
+                await stream.aclose()
+                raise
+
+        return self.loop.run(self.stream_caller.call(make_call, self.first_chunk_timeout),
+                             timeout=self.first_chunk_timeout + 1)
+
+    @staticmethod
+    async def next_chunk(stream):
+        try:
+            return await stream.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    @staticmethod
+    async def close_stream(stream):
+        await stream.aclose()
+
+    def open_stream(self, image, audio, scene=None):
+        deadline = time.monotonic() + self.stream_timeout
+        contents, generation_config = self.build_request(image, audio, scene)
+        try:
+            stream, chunk = self.open_first_chunk(contents, generation_config)
+        except errors.ClientError as e:
+            if not self.uses_cache(generation_config) or not is_cache_miss(e):
+                raise
+            self.prompt_cache.invalidate(self.model_name, self.language)
+            contents, generation_config = self.build_request(image, audio, scene, use_cache=False)
+            stream, chunk = self.open_first_chunk(contents, generation_config)
+        if stream is None:
+            return
+        try:
+            while chunk is not None:
+                yield chunk
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"LLM stream exceeded its {self.stream_timeout}s deadline")
+                try:
+                    chunk = self.loop.run(self.next_chunk(stream), timeout=remaining)
+                except TimeoutError as e:
+                    raise TimeoutError(f"LLM stream exceeded its {self.stream_timeout}s deadline") from e
+        finally:
+            # also runs when the caller stops reading early, so the connection is released
+            self.loop.run(self.close_stream(stream), timeout=1)
+
+    def stream_full_response(self, image, audio, scene=None):
+        parser = StreamingResponseParser()
+        for chunk in self.open_stream(image, audio, scene):
+            if chunk.text:
+                yield from parser.feed(chunk.text)
+        yield from parser.close()
+        yield "output", self._parse_response(parser.buffer.strip())
+
     def _parse_response(self, raw_response):
         output = {"raw_response": raw_response}
         response_text = ""
@@ -79,18 +398,75 @@ class LLM:
                     pass
             objects_match = re.search(r'"search_objects":\s*(\[.*?])', raw_response, re.DOTALL)
             if objects_match:
-                is_list, object_list = self._parse_list(objects_match.group(1))
+                is_list, object_list = parse_list(objects_match.group(1))
             output["warning"] = f"Error decoding JSON. Raw response: {raw_response}"
         output["response_text"] = response_text
         output["object_list"] = object_list
         output["is_list"] = is_list
         return output
 
-    def _parse_list(self, s):
-        try:
-            s_eval = ast.literal_eval(s)
-            is_list = isinstance(s_eval, list)
-            list_processed = [str(s) for s in s_eval] if is_list else []
-            return is_list, list_processed
-        except:
-            return False, []
+
+class AnswerCache:
+    def __init__(self, max_entries=256, frame_threshold=6):
+        self.max_entries = max_entries
+        self.frame_threshold = frame_threshold
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def matches(self, entry, frame_hash, audio_fingerprint, context):
+        # the question and the request context (language, model, prompt mode) must be the same;
+        # only the frame is allowed to differ slightly
+        return (entry["audio_fingerprint"] == audio_fingerprint and entry["context"] == context and
+                bin(entry["frame_hash"] ^ frame_hash).count("1") <= self.frame_threshold)
+
+    def lookup(self, frame_hash, audio_fingerprint, context, ttl):
+        now = time.monotonic()
+        with self.lock:
+            for entry_id, entry in list(self.entries.items()):
+                if now - entry["created"] > ttl:
+                    continue
+                if self.matches(entry, frame_hash, audio_fingerprint, context):
+                    self.entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return entry["output"]
+            self.misses += 1
+            return None
+
+    def store(self, frame_hash, audio_fingerprint, context, output, max_ttl):
+        now = time.monotonic()
+        with self.lock:
+            for entry_id in [i for i, e in self.entries.items() if now - e["created"] > max_ttl]:
+                del self.entries[entry_id]
+                self.expired += 1
+            self.entries[self.next_id] = {
+                "frame_hash": frame_hash,
+                "audio_fingerprint": audio_fingerprint,
+                "context": context,
+                "output": output,
+                "created": now
+            }
+            self.next_id += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "expired": self.expired,
+            "evicted": self.evicted
+        }
+
+
+@st.cache_resource
+def get_answer_cache():
+    return AnswerCache()
@@ -0,0 +1,205 @@
+import threading
+import time
+
+# returned by a stage function that chose not to process its item, so it is not counted as processed
+SKIPPED = object()
+
+
+class LatestSlot:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.seq = 0
+        self.taken_seq = 0
+        self.dropped = 0
+        self.closed = False
+        self.put_at = None
+        self.taken_at = None
+
+    def put(self, item):
+        with self.condition:
+            # the previous item was never taken, so it is superseded
+            if self.seq > self.taken_seq:
+                self.dropped += 1
+            self.item = item
+            self.seq += 1
+            self.put_at = time.perf_counter()
+            self.condition.notify_all()
+            return self.seq
+
+    def take(self, timeout=None):
+        with self.condition:
+            ready = self.condition.wait_for(lambda: self.closed or self.seq > self.taken_seq, timeout)
+            if not ready or self.closed:
+                return None, None
+            self.taken_seq = self.seq
+            self.taken_at = self.put_at
+            return self.item, self.seq
+
+    def peek(self):
+        with self.condition:
+            return self.item
+
+    def clear(self):
+        with self.condition:
+            self.item = None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class PipelineStage:
+    def __init__(self, name, fn, inbox, outbox=None, on_error=None):
+        self.name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.on_error = on_error
+        self.processed = 0
+        self.skipped = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.started_at = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"stage-{name}", daemon=True)
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stop_event.is_set():
+            item, _ = self.inbox.take(timeout=0.5)
+            if item is None:
+                continue
+            start = time.perf_counter()
+            try:
+                result = self.fn(item)
+            except Exception as e:
+                self.errors += 1
+                if self.on_error is not None:
+                    self.on_error(self.name, e)
+                continue
+            if result is SKIPPED:
+                self.skipped += 1
+                continue
+            self.busy_time += time.perf_counter() - start
+            self.processed += 1
+            # stages return None when there is nothing to hand downstream
+            if self.outbox is not None and result is not None:
+                self.outbox.put(result)
+
+    def stop(self):
+        self.stop_event.set()
+        self.inbox.close()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started_at if self.started_at else 0.0
+        return {
+            "processed": self.processed,
+            "skipped": self.skipped,
+            "dropped": self.inbox.dropped,
+            "errors": self.errors,
+            "fps": self.processed / elapsed if elapsed else 0.0,
+            "latency_ms": 1000 * self.busy_time / self.processed if self.processed else 0.0
+        }
+
+
+class QualityGovernor:
+    def __init__(self, target_ms=150, imgsz_levels=(640, 512, 416, 320), max_skip=3, headroom=0.6,
+                 max_backlog=2, smoothing=0.2, cooldown=1.0):
+        self.target_ms = target_ms
+        self.imgsz_levels = imgsz_levels
+        self.max_skip = max_skip
+        self.headroom = headroom
+        self.max_backlog = max_backlog
+        self.smoothing = smoothing
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.level = 0
+        self.skip = 0
+        self.seg_paused = False
+        self.latency_ms = None
+        self.backlog = 0
+        self.last_change = 0.0
+        self.frames = 0
+        self.skipped = 0
+        self.downgrades = 0
+        self.upgrades = 0
+
+    @property
+    def imgsz(self):
+        return self.imgsz_levels[self.level]
+
+    def should_process(self):
+        # with skip = n only every (n + 1)-th frame reaches the model
+        with self.lock:
+            self.frames += 1
+            if self.frames % (self.skip + 1):
+                self.skipped += 1
+                return False
+            return True
+
+    def observe(self, latency_ms, backlog=0):
+        # latency_ms is end to end: from the frame reaching recv until its detections are ready
+        with self.lock:
+            if self.latency_ms is None:
+                self.latency_ms = latency_ms
+            else:
+                self.latency_ms += self.smoothing * (latency_ms - self.latency_ms)
+            self.backlog = backlog
+            now = time.monotonic()
+            if now - self.last_change < self.cooldown:
+                return
+            if self.latency_ms > self.target_ms or backlog > self.max_backlog:
+                changed = self._degrade()
+                self.downgrades += changed
+            elif self.latency_ms < self.headroom * self.target_ms and backlog == 0:
+                changed = self._upgrade()
+                self.upgrades += changed
+            else:
+                changed = False
+            if changed:
+                self.last_change = now
+
+    def _degrade(self):
+        # cheapest quality loss first: resolution, then frame rate, then segmentation keyframes
+        if self.level < len(self.imgsz_levels) - 1:
+            self.level += 1
+        elif self.skip < self.max_skip:
+            self.skip += 1
+        elif not self.seg_paused:
+            self.seg_paused = True
+        else:
+            return False
+        return True
+
+    def _upgrade(self):
+        if self.seg_paused:
+            self.seg_paused = False
+        elif self.skip > 0:
+            self.skip -= 1
+        elif self.level > 0:
+            self.level -= 1
+        else:
+            return False
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "imgsz": self.imgsz,
+                "frame_skip": self.skip,
+                "seg_paused": self.seg_paused,
+                "latency_ms": self.latency_ms or 0.0,
+                "target_ms": self.target_ms,
+                "backlog": self.backlog,
+                "skipped": self.skipped,
+                "downgrades": self.downgrades,
+                "upgrades": self.upgrades
+            }
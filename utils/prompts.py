@@ -1,3 +1,6 @@
+from functools import lru_cache
+
+
 ORIGINAL_PROMPT = f"""
 You are an AR navigation assistant. Describe the image to help someone navigate safely and orient themselves.
 
@@ -45,6 +48,7 @@ You are an AR navigation assistant. Describe the image to help someone navigate
 """
 
 
+@lru_cache(maxsize=None)
 def get_prompt(language):
     prompt_joined = f"""
     You are an AR assistant for visually disabled people, navigating primarily indoors and occasionally outdoors. 
@@ -0,0 +1,36 @@
+import streamlit as st
+from google import genai
+import azure.cognitiveservices.speech as speechsdk
+from utils.secrets_utils import get_secrets
+from utils.storage_utils import StorageClient
+
+
+@st.cache_resource
+def get_shared_secrets(host):
+    return get_secrets(host)
+
+
+@st.cache_resource
+def get_storage_client(host):
+    return StorageClient(get_shared_secrets(host))
+
+
+@st.cache_resource
+def ensure_model_weights(host, weights):
+    get_storage_client(host).load_model_weights(weights)
+    return weights
+
+
+@st.cache_resource
+def get_genai_client(api_key):
+    # one client per process keeps its HTTP connection pool warm across reruns and sessions
+    return genai.Client(api_key=api_key)
+
+
+@st.cache_resource
+def get_speech_config(key, region, voice):
+    config = speechsdk.SpeechConfig(subscription=key, region=region)
+    config.speech_synthesis_voice_name = voice
+    # raw PCM so streamed chunks can be concatenated; audio_utils adds the WAV header
+    config.set_speech_synthesis_output_format(speechsdk.SpeechSynthesisOutputFormat.Raw24Khz16BitMonoPcm)
+    return config
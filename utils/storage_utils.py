@@ -1,28 +1,307 @@
 import os
+import fcntl
+import json
+import logging
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError
 from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
 from datetime import datetime, timedelta
 
 
+CHUNK_SIZE = 4 * 1024 * 1024
+logger = logging.getLogger(__name__)
+download_locks = {}
+download_locks_guard = threading.Lock()
+
+
+def get_download_lock(path):
+    with download_locks_guard:
+        return download_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def download_blob_to_file(blob_client, path, size, etag, chunk_size=CHUNK_SIZE, max_workers=4):
+    part_path = path + ".part"
+    state_path = path + ".state"
+    done = set()
+    if os.path.exists(part_path) and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        # a partial download is only resumable if the blob has not changed since
+        if state.get("etag") == etag and state.get("chunk_size") == chunk_size:
+            done = set(state["done"])
+    if not done:
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+    offsets = [offset for offset in range(0, size, chunk_size) if offset not in done]
+    write_lock = threading.Lock()
+
+    with open(part_path, "r+b") as part_file:
+        def fetch(offset):
+            length = min(chunk_size, size - offset)
+            data = blob_client.download_blob(offset=offset, length=length, etag=etag,
+                                             match_condition=MatchConditions.IfNotModified).readall()
+            with write_lock:
+                part_file.seek(offset)
+                part_file.write(data)
+                part_file.flush()
+                done.add(offset)
+                with open(state_path, "w") as f:
+                    json.dump({"etag": etag, "chunk_size": chunk_size, "done": sorted(done)}, f)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                list(pool.map(fetch, offsets))
+        except ResourceModifiedError:
+            part_file.close()
+            for stale_path in (part_path, state_path):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            raise
+        os.fsync(part_file.fileno())
+    if os.path.getsize(part_path) != size:
+        raise RuntimeError(f"Downloaded size of {path} does not match the blob.")
+    os.replace(part_path, path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+
+def file_md5(path, chunk_size=CHUNK_SIZE):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.digest()
+
+
+class FileLock:
+    def __init__(self, path, timeout=3600, poll_interval=0.5):
+        # flock is released by the kernel when the holder exits, so a crashed worker never leaves a stale lock
+        # and a long download keeps its lock for as long as it runs
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.fd = None
+
+    def __enter__(self):
+        start = time.time()
+        fd = os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o644)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.fd = fd
+                return self
+            except BlockingIOError:
+                pass
+            if time.time() - start > self.timeout:
+                os.close(fd)
+                raise TimeoutError(f"Timed out waiting for lock {self.path}")
+            time.sleep(self.poll_interval)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # the lock file stays in place: unlinking it would let a waiter lock an orphaned inode
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+class BlobCache:
+    def __init__(self, container_client, cache_dir=".blob_cache", max_bytes=2 * 1024 ** 3,
+                 chunk_size=CHUNK_SIZE, max_workers=4, max_fetches=2):
+        self.container_client = container_client
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        # background fetches get their own threads: a multi-GB download must not hold a request worker
+        self.fetch_executor = ThreadPoolExecutor(max_workers=max_fetches, thread_name_prefix="blob-fetch")
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path_for(self, blob_name, etag):
+        key = f"{self.container_client.container_name}/{blob_name}@{etag}"
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest + os.path.splitext(blob_name)[1])
+
+    def lookup(self, blob_name, etag):
+        path = self.path_for(blob_name, etag)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def fetch(self, blob_name):
+        blob_client = self.container_client.get_blob_client(blob_name)
+        properties = blob_client.get_blob_properties()
+        path = self.path_for(blob_name, properties.etag)
+        with get_download_lock(path):
+            if not os.path.exists(path):
+                download_blob_to_file(blob_client, path, properties.size, properties.etag,
+                                      self.chunk_size, self.max_workers)
+        os.utime(path)
+        self.evict(keep=path)
+        return path
+
+    def fetch_async(self, blob_name):
+        with self.pending_lock:
+            # a video selected again while it is still downloading shares the running fetch
+            future = self.pending.get(blob_name)
+            if future is not None:
+                return future
+            future = self.fetch_executor.submit(self.fetch, blob_name)
+            self.pending[blob_name] = future
+        # outside the lock: the callback runs right away if the fetch has already finished
+        future.add_done_callback(lambda f: self.fetch_done(blob_name, f))
+        return future
+
+    def fetch_done(self, blob_name, future):
+        with self.pending_lock:
+            if self.pending.get(blob_name) is future:
+                del self.pending[blob_name]
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Background fetch of %s failed: %s", blob_name, future.exception())
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith((".part", ".state")) or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+class VideoCatalog:
+    def __init__(self, storage_client, ttl=300):
+        self.storage_client = storage_client
+        self.ttl = ttl
+        self.videos = None
+        self.names = []
+        self.search_keys = []
+        self.version = 0
+        self.updated_at = 0
+        self.error = None
+        self.refreshing = False
+        self.loaded = threading.Event()
+        self.lock = threading.Lock()
+
+    def snapshot(self, wait=0):
+        if time.time() - self.updated_at > self.ttl:
+            self.refresh_async()
+        if self.videos is None and wait:
+            self.loaded.wait(wait)
+        return self.videos or {}
+
+    def search(self, query=""):
+        self.snapshot()
+        with self.lock:
+            names, search_keys = self.names, self.search_keys
+        query = query.strip().lower()
+        if not query:
+            return names
+        return [name for name, key in zip(names, search_keys) if query in key]
+
+    def refresh_async(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def refresh(self):
+        try:
+            videos = self.storage_client.list_azure_videos()
+            # listings have no conditional GET, so only publish a new version when the content changed
+            changed = self.videos is None or self.fingerprint(videos) != self.fingerprint(self.videos)
+            with self.lock:
+                if changed:
+                    self.videos = videos
+                    self.names = sorted(videos, key=str.lower)
+                    self.search_keys = [f"{name} {videos[name]['name']}".lower() for name in self.names]
+                    self.version += 1
+                self.error = None
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.lock:
+                self.updated_at = time.time()
+                self.refreshing = False
+            self.loaded.set()
+
+    @staticmethod
+    def fingerprint(videos):
+        return {name: video["etag"] for name, video in videos.items()}
+
+
+@st.cache_resource
+def get_video_catalog(_storage_client):
+    catalog = VideoCatalog(_storage_client)
+    catalog.refresh_async()
+    return catalog
+
+
 class StorageClient:
     def __init__(self, secrets):
         self.connection_string = secrets["CONNECTION_STRING"]
+        self.service_client = BlobServiceClient.from_connection_string(self.connection_string)
         self.video_client = self.get_blob_container_client()
+        self.video_cache = BlobCache(self.video_client)
 
     def get_blob_container_client(self, container_name="videos"):
-        blob_service_client = BlobServiceClient.from_connection_string(self.connection_string)
-        container_client = blob_service_client.get_container_client(container_name)
+        container_client = self.service_client.get_container_client(container_name)
         return container_client
 
     def load_model_weights(self, weights, save_to_root=True):
+        if not save_to_root:
+            return
         model_client = self.get_blob_container_client("models")
         for blob_name in weights.values():
-            if not os.path.exists(blob_name):
-                blob_client = model_client.get_blob_client(blob_name)
-                blob_data = blob_client.download_blob().readall()
-                if save_to_root:
-                    with open(blob_name, "wb") as download_file:
-                        download_file.write(blob_data)
+            blob_client = model_client.get_blob_client(blob_name)
+            properties = blob_client.get_blob_properties()
+            if self.is_valid_download(blob_name, properties):
+                continue
+            # concurrent app workers share one download through the lock file
+            with FileLock(blob_name + ".lock"):
+                if self.is_valid_download(blob_name, properties):
+                    continue
+                download_blob_to_file(blob_client, blob_name, properties.size, properties.etag)
+                expected_md5 = properties.content_settings.content_md5
+                if expected_md5 and file_md5(blob_name) != bytes(expected_md5):
+                    os.remove(blob_name)
+                    raise RuntimeError(f"MD5 mismatch for downloaded model weights {blob_name}")
+                with open(blob_name + ".etag", "w") as f:
+                    f.write(properties.etag)
+
+    def is_valid_download(self, path, properties):
+        if not os.path.exists(path) or os.path.getsize(path) != properties.size:
+            return False
+        etag_path = path + ".etag"
+        if os.path.exists(etag_path):
+            with open(etag_path) as f:
+                return f.read() == properties.etag
+        # files from before the etag sidecar existed are verified once by content hash
+        expected_md5 = properties.content_settings.content_md5
+        if not expected_md5 or file_md5(path) != bytes(expected_md5):
+            return False
+        with open(etag_path, "w") as f:
+            f.write(properties.etag)
+        return True
 
     def list_azure_videos(self):
         video_extensions = ['.mp4', '.avi', '.mov', '.mkv', '.webm', '.flv', '.wmv']
@@ -35,7 +314,8 @@ class StorageClient:
                     'display_name': os.path.basename(blob.name),
                     'size': blob.size,
                     'size_mb': f"{blob.size / (1024 * 1024):.1f} MB",
-                    'last_modified': blob.last_modified
+                    'last_modified': blob.last_modified,
+                    'etag': blob.etag
                 }
                 video['desc'] = f"{video['display_name']} ({video['size_mb']})"
                 videos[video['display_name']] = video
@@ -1,14 +1,19 @@
-import concurrent.futures
+import os
+import time
+import numpy as np
 import streamlit as st
 import streamlit.components.v1 as components
 from audiorecorder import audiorecorder
 from streamlit_webrtc import webrtc_streamer
-from utils.secrets_utils import get_secrets
 from utils.webrtc_utils import FrameCaptureProcessor
-from utils.storage_utils import StorageClient
-from utils.audio_utils import text_to_speech, audio_to_base64
-from utils.cv_utils import create_yolo_model, capture_frame, parse_timestamp, image_to_bytes
-from utils.llm_utils import LLM
+from utils.storage_utils import get_video_catalog
+from utils.resource_utils import get_shared_secrets, get_storage_client, ensure_model_weights
+from utils.audio_utils import text_to_speech, PreparedAudio, wav_duration, autoplay_html
+from utils.cv_utils import create_yolo_model, capture_frame, parse_timestamp, PreparedImage, TrackHistory, \
+    format_scene
+from utils.llm_utils import LLM, get_answer_cache
+from utils.task_utils import TaskGraph, get_executor
+from utils.inference_utils import get_inference_service
 
 
 MODEL_WEIGHTS = {
@@ -16,6 +21,45 @@ MODEL_WEIGHTS = {
     "yoloe_model": "yoloe-11l-seg.pt",
     "clip_model": "mobileclip_blt.ts"
 }
+STAGE_TIMEOUTS = {
+    "segmentation": 15,
+    "overlay": 5,
+    "speech": 20
+}
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "0"))  # 0 keeps detection in the server process
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")  # torch, onnx or openvino
+INFERENCE_INT8 = os.getenv("INFERENCE_INT8", "0") == "1"
+# exported YOLOE graphs have a fixed vocabulary; other requested classes fall back to the PyTorch model
+YOLOE_EXPORT_CLASSES = tuple(c.strip() for c in os.getenv("YOLOE_EXPORT_CLASSES", "").split(",") if c.strip())
+LLM_IMAGE = {
+    "fmt": os.getenv("LLM_IMAGE_FORMAT", "jpeg"),  # jpeg, webp or png
+    "quality": int(os.getenv("LLM_IMAGE_QUALITY", "85")),
+    "max_side": int(os.getenv("LLM_IMAGE_MAX_SIDE", "1024")),
+    "roi": float(os.getenv("LLM_IMAGE_ROI", "0")) or None  # fraction of each side kept around the centre
+}
+PROMPT_MODES = {
+    "Image": "image",
+    "Detections + small image": "grounded",
+    "Detections only": "detections"
+}
+GROUNDED_IMAGE = {"fmt": "jpeg", "quality": 60, "max_side": 384, "roi": None}
+LLM_AUDIO = {
+    "fmt": os.getenv("LLM_AUDIO_FORMAT", "flac"),  # flac, opus or wav
+    "sample_rate": 16000
+}
+LLM_REQUEST = {
+    "timeout": 30,  # seconds for all attempts of one question together
+    "first_chunk_timeout": 10,  # streamed answers: seconds until the first chunk, retries included
+    "stream_timeout": 60,  # streamed answers: seconds for the whole stream
+    "max_retries": 2,
+    "hedge": os.getenv("LLM_HEDGE", "1") == "1"  # duplicate requests slower than the recent p95
+}
+ANSWER_CACHE_TTL = {
+    "video": 3600,  # replaying a timestamp shows the same frame
+    "camera": 10  # a live scene can change without the frame hash noticing
+}
+CATALOG_PAGE_SIZE = 50
+CATALOG_INITIAL_WAIT = 5  # seconds
 LANGUAGES = ["English", "Nederlands", "Vlaams", "Deutsch", "Français"]
 
 
@@ -32,6 +76,8 @@ class StreamlitUI:
             "current_frame": None,
             "show_bb": False,
             "dynamic_segmentation": False,
+            "stream_response": True,
+            "prompt_mode": "image",
             "language": "English"
         }
         for k, v in defaults.items():
@@ -39,11 +85,15 @@ class StreamlitUI:
                 self.session[k] = v
 
         self.session["host"] = self.host
-        self.session["secrets"] = get_secrets(self.host)
+        self.session["secrets"] = get_shared_secrets(self.host)
 
-        self.session["storage_client"] = StorageClient(self.session["secrets"])
-        self.session["storage_client"].load_model_weights(MODEL_WEIGHTS)
-        self.session["yolo_model"] = create_yolo_model(MODEL_WEIGHTS)
+        self.session["storage_client"] = get_storage_client(self.host)
+        ensure_model_weights(self.host, MODEL_WEIGHTS)
+        self.session["yolo_model"] = create_yolo_model(MODEL_WEIGHTS, INFERENCE_BACKEND, INFERENCE_INT8,
+                                                        YOLOE_EXPORT_CLASSES)
+        self.session["inference_service"] = None
+        if INFERENCE_WORKERS > 0:
+            self.session["inference_service"] = get_inference_service(self.session["yolo_model"], INFERENCE_WORKERS)
 
     def display_sidebar(self):
         st.sidebar.markdown("## Input Source")
@@ -66,7 +116,17 @@ class StreamlitUI:
             self.session["language"] = language
             st.rerun()
         self.session["model_name"] = "gemini-2.5-flash"
-        self.session["LLM"] = LLM(self.session)
+        self.session["LLM"] = LLM(self.session, **LLM_REQUEST)
+        stream_response = st.sidebar.checkbox("Stream Response", value=self.session["stream_response"])
+        if stream_response != self.session["stream_response"]:
+            self.session["stream_response"] = stream_response
+            st.rerun()
+        modes = list(PROMPT_MODES.values())
+        prompt_mode = PROMPT_MODES[st.sidebar.selectbox("Prompt Input", list(PROMPT_MODES),
+                                                        index=modes.index(self.session["prompt_mode"]))]
+        if prompt_mode != self.session["prompt_mode"]:
+            self.session["prompt_mode"] = prompt_mode
+            st.rerun()
         if self.session["mode"] == "camera":
             show_bb = st.sidebar.checkbox("Show YOLO Bounding Boxes", value=self.session["show_bb"])
             if show_bb != self.session["show_bb"]:
@@ -87,11 +147,13 @@ class StreamlitUI:
         yolo_model = self.session["yolo_model"]
         show_bb = self.session["show_bb"]
         dynamic_segmentation = self.session["dynamic_segmentation"]
+        inference_service = self.session["inference_service"]
 
         st.markdown("## 📸 Live Camera Input")
         webrtc_ctx = webrtc_streamer(
             key="camera_streamer",
-            video_processor_factory=lambda: FrameCaptureProcessor(yolo_model, show_bb, dynamic_segmentation),
+            video_processor_factory=lambda: FrameCaptureProcessor(yolo_model, show_bb, dynamic_segmentation,
+                                                                  inference_service),
             media_stream_constraints={"video": True, "audio": False},
             rtc_configuration={
                 "iceServers": [{"urls": ["stun:stun.l.google.com:19302"]}]
@@ -100,19 +162,49 @@ class StreamlitUI:
         )
         self.video_processor = webrtc_ctx.video_processor
         if webrtc_ctx.state.playing and self.video_processor:
+            self.video_processor.set_scene_tracking(self.session["prompt_mode"] != "image")
+            stats = self.video_processor.get_stats()
+            st.sidebar.caption(f"Frames: {stats['frames_received']} received, {stats['frames_processed']} processed, "
+                               f"{stats['frames_skipped']} skipped, {stats['frames_dropped']} dropped")
+            st.sidebar.caption(" | ".join(f"{name}: {stage['fps']:.1f} fps, {stage['latency_ms']:.0f} ms"
+                                          for name, stage in stats["stages"].items()))
+            governor = stats["governor"]
+            st.sidebar.caption(f"Governor: {governor['latency_ms']:.0f}/{governor['target_ms']} ms, "
+                               f"imgsz {governor['imgsz']}, skip {governor['frame_skip']}, "
+                               f"segmentation {'paused' if governor['seg_paused'] else 'on'} "
+                               f"({governor['downgrades']} down, {governor['upgrades']} up)")
+            session_bytes = stats["frame_bytes"] + stats["mask_bytes"] + stats["overlay_bytes"]
+            st.sidebar.caption(f"Session memory: {session_bytes / (1024 * 1024):.1f} MB "
+                               f"(masks {stats['mask_bytes'] / 1024:.0f} KB)")
             self.process_audio_and_image()
         else:
             st.warning("Please start the camera.")
 
     def video_mode(self):
-        videos = self.session["storage_client"].list_azure_videos()
+        catalog = get_video_catalog(self.session["storage_client"])
+        videos = catalog.snapshot(wait=CATALOG_INITIAL_WAIT)
         if not videos:
-            st.error("No videos found in Azure storage")
+            if not catalog.loaded.is_set():
+                st.info("Loading video library...")
+                st.button("Refresh")
+            elif catalog.error is not None:
+                st.error(f"Could not list videos in Azure storage: {catalog.error}")
+            else:
+                st.error("No videos found in Azure storage")
             return
 
         st.sidebar.markdown("## Select Video from Azure")
         default = "Choose video..."
-        options = [default] + list(videos.keys())
+        query = st.sidebar.text_input("Filter videos", key="video_filter")
+        names = catalog.search(query)
+        pages = max(1, -(-len(names) // CATALOG_PAGE_SIZE))
+        page = 1
+        if pages > 1:
+            page = st.sidebar.selectbox(f"Page (of {pages})", range(1, pages + 1), key="video_page")
+        page_names = names[(page - 1) * CATALOG_PAGE_SIZE:page * CATALOG_PAGE_SIZE]
+        options = [default] + page_names
+        if self.session.get("video_name") in videos and self.session["video_name"] not in options:
+            options.insert(1, self.session["video_name"])
 
         current_video = self.session.get("video_name", default)
         index = options.index(current_video) if current_video in options else 0
@@ -122,6 +214,9 @@ class StreamlitUI:
             if video_name != self.session.get("video_name"):
                 self.session["video_name"] = video_name
                 video = videos[video_name]
+                self.session["video_blob"] = video
+                # fill the local blob cache in the background; frames come from the URL until it is ready
+                self.session["storage_client"].video_cache.fetch_async(video["name"])
                 st.sidebar.markdown(f"## Selected {video['desc']}")
                 video_url = self.session["storage_client"].get_video_url(video["name"])
                 if video_url:
@@ -145,7 +240,10 @@ class StreamlitUI:
     def get_image(self):
         image = None
         if self.session["mode"] == "video":
-            image = capture_frame(self.session.get("video_url"), self.session.get("tms"))
+            video = self.session["video_blob"]
+            video_path = self.session["storage_client"].video_cache.lookup(video["name"], video["etag"])
+            image = capture_frame(video_path or self.session.get("video_url"), self.session.get("tms"),
+                                  video_key=video["name"])
         elif self.session["mode"] == "camera":
             if self.video_processor is None:
                 st.error("Camera processor is not active. Please start the camera.")
@@ -154,21 +252,135 @@ class StreamlitUI:
             if image is None:
                 st.error("Could not capture a frame from the camera.")
                 return
-        img_bytes = image_to_bytes(image)
-        return image, img_bytes
+        image_settings = GROUNDED_IMAGE if self.session["prompt_mode"] != "image" else LLM_IMAGE
+        prepared_image = PreparedImage(image, **image_settings)
+        return image, prepared_image
+
+    def get_scene(self, image):
+        if self.session["prompt_mode"] == "image":
+            return None
+        if self.session["mode"] == "camera":
+            return format_scene(self.video_processor.get_scene())
+        # a single video frame has no track history, so there is direction and distance but no motion
+        frame = np.asarray(image)
+        detections = self.session["yolo_model"].predict(frame)
+        return format_scene(TrackHistory().describe(detections, frame.shape))
 
     def search_objects(self, llm_model, audio_base64):
         is_list, objects, resp = llm_model.search_audio(audio_base64)
         return is_list, objects, resp
 
-    def process_llm(self, audio, img_bytes):
-        audio_base64 = audio_to_base64(audio)
+    def process_llm(self, prepared_audio, prepared_image, scene=None):
         try:
-            output = self.session["LLM"].get_full_response(img_bytes, audio_base64)
+            output = self.session["LLM"].get_full_response(prepared_image, prepared_audio, scene)
         except Exception as e:
             output = {"error": f"Error during LLM processing: {e}"}
         return output
 
+    def process_llm_stream(self, prepared_audio, image, prepared_image, graph, scene=None):
+        text_placeholder = st.empty()
+        sentences = []
+        objects = None
+        output = None
+        try:
+            for event, value in self.session["LLM"].stream_full_response(prepared_image, prepared_audio, scene):
+                if event == "search_objects":
+                    objects = value
+                    self.start_segmentation(graph, image, objects)
+                elif event == "sentence":
+                    sentences.append(value)
+                    text_placeholder.markdown(" ".join(sentences))
+                    if len(sentences) == 1:
+                        # speak the first sentence while the rest is still being generated
+                        self.start_speech(graph, value)
+                elif event == "output":
+                    output = value
+                self.render_stages(graph, block=False)
+        except Exception as e:
+            st.error(f"Error during LLM processing: {e}")
+            return
+        if "warning" in output:
+            st.warning(output["warning"])
+        if not sentences:
+            text_placeholder.markdown(output["response_text"])
+            self.start_speech(graph, output["response_text"])
+        elif len(sentences) > 1:
+            self.start_speech(graph, " ".join(sentences[1:]))
+        if objects is None:
+            objects = output["object_list"]
+            self.start_segmentation(graph, image, objects)
+        st.markdown(f"Objects: {objects}")
+        self.render_stages(graph)
+        return output
+
+    def answer_context(self):
+        # everything besides the frame and the question that changes what the model answers
+        return self.session["language"], self.session["model_name"], self.session["prompt_mode"]
+
+    def cached_answer(self, prepared_image, prepared_audio):
+        return get_answer_cache().lookup(prepared_image.dhash, prepared_audio.fingerprint,
+                                         self.answer_context(), ANSWER_CACHE_TTL[self.session["mode"]])
+
+    def cache_answer(self, prepared_image, prepared_audio, output):
+        get_answer_cache().store(prepared_image.dhash, prepared_audio.fingerprint,
+                                 self.answer_context(), output, max(ANSWER_CACHE_TTL.values()))
+
+    def new_task_graph(self):
+        # a new question supersedes whatever the previous one still has in flight
+        previous = self.session.get("task_graph")
+        if previous is not None:
+            previous.cancel()
+        graph = TaskGraph(get_executor())
+        self.session["task_graph"] = graph
+        self.speech_outputs = {}
+        self.next_speech = 0
+        self.playback_end = None
+        return graph
+
+    def start_segmentation(self, graph, image, objects):
+        if self.session["dynamic_segmentation"] and self.session["mode"] == "camera":
+            self.video_processor.set_seg_classes(objects, None)
+            return
+        self.seg_objects = objects
+        yolo_model = self.session["yolo_model"]
+        graph.add("segmentation", yolo_model.run_yoloe, image, objects, timeout=STAGE_TIMEOUTS["segmentation"])
+        if self.video_processor is None and objects:
+            graph.add("overlay", yolo_model.render_segmentation, image, deps=["segmentation"],
+                      timeout=STAGE_TIMEOUTS["overlay"])
+
+    def start_speech(self, graph, text):
+        tts_session = {"secrets": self.session["secrets"], "language": self.session["language"]}
+        graph.add(f"speech_{len(self.speech_outputs)}", text_to_speech, tts_session, text,
+                  timeout=STAGE_TIMEOUTS["speech"])
+        self.speech_outputs[len(self.speech_outputs)] = False
+
+    def render_stages(self, graph, block=True):
+        for name, result, error in graph.as_completed(block=block):
+            if error is not None:
+                st.warning(f"Stage '{name}' failed: {error}")
+            if name == "segmentation" and error is None and self.video_processor is not None:
+                self.video_processor.set_seg_classes(self.seg_objects, result)
+            elif name == "overlay" and error is None:
+                st.image(result)
+            elif name.startswith("speech_"):
+                self.speech_outputs[int(name.split("_")[1])] = result
+                self.flush_speech()
+
+    def flush_speech(self):
+        # play sentences in order, each one starting after the previous has finished
+        while self.speech_outputs.get(self.next_speech, False) is not False:
+            tts_output = self.speech_outputs[self.next_speech]
+            self.next_speech += 1
+            if tts_output:
+                self.playback_end = self.play_speech(tts_output, start_at=self.playback_end)
+
+    def play_speech(self, tts_output, start_at=None):
+        response_bytes, response_base64 = tts_output
+        delay = max(0.0, start_at - time.time()) if start_at else 0.0
+        st.audio(response_bytes, format="audio/wav", start_time=0)
+        components.html(autoplay_html(response_base64, delay), height=1)
+        return time.time() + delay + wav_duration(response_bytes.getvalue())
+
     def process_audio_and_image(self) -> None:
         col_label_audio, col_input_audio = st.columns([1, 1])
         with col_label_audio:
@@ -176,36 +388,52 @@ class StreamlitUI:
         with col_input_audio:
             audio = audiorecorder("🎙️ Start recording", "🔴 Stop recording", key="audio")
         if len(audio) > 0:
-            image, img_bytes = self.get_image()
+            graph = self.new_task_graph()
+            image, prepared_image = self.get_image()
+            prepared_audio = PreparedAudio(audio, **LLM_AUDIO)
+            scene = self.get_scene(image)
+            # the frame is always prepared: its hash keys the answer cache even when it is not sent
+            llm_image = prepared_image if self.session["prompt_mode"] != "detections" else None
             col_img, col_audio = st.columns(2)
             with col_img:
                 st.image(image)
+                if llm_image is not None:
+                    st.caption(f"Sent as {prepared_image.fmt} {prepared_image.shape[1]}x{prepared_image.shape[0]}, "
+                               f"{prepared_image.size / 1024:.0f} KB, encoded in {prepared_image.encode_ms:.0f} ms")
+                if scene is not None:
+                    st.caption(f"Detections sent ({len(scene)} characters):")
+                    st.text(scene)
             with col_audio:
                 st.audio(audio.export().read())
+                st.caption(f"Sent {prepared_audio.duration_s:.1f} of {prepared_audio.source_duration_s:.1f} s as "
+                           f"{prepared_audio.fmt}, {prepared_audio.size / 1024:.0f} KB "
+                           f"({prepared_audio.saved_bytes / 1024:.0f} KB saved)")
+            output = self.cached_answer(prepared_image, prepared_audio)
+            cache_stats = get_answer_cache().stats()
+            st.sidebar.caption(f"Answer cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                               f"{cache_stats['entries']} entries")
             with st.spinner("Processing audio and image..."):
-                output = self.process_llm(audio, img_bytes)
-                # st.info(f"Raw response: {output['raw_response']}")
-                if "error" in output:
-                    st.error(output["error"])
+                if output is not None:
+                    st.caption("Answered from cache")
+                elif self.session["stream_response"]:
+                    output = self.process_llm_stream(prepared_audio, image, llm_image, graph, scene)
+                    if output is not None and "warning" not in output:
+                        self.cache_answer(prepared_image, prepared_audio, output)
                     return
-                if "warning" in output:
-                    st.warning(output["warning"])
+                else:
+                    output = self.process_llm(prepared_audio, llm_image, scene)
+                    # st.info(f"Raw response: {output['raw_response']}")
+                    if "error" in output:
+                        st.error(output["error"])
+                        return
+                    if "warning" in output:
+                        st.warning(output["warning"])
+                    else:
+                        self.cache_answer(prepared_image, prepared_audio, output)
                 response_text = output["response_text"]
                 objects = output["object_list"]
                 st.markdown(f"Objects: {objects}")
-                if not self.session["dynamic_segmentation"]:
-                    seg_results = self.session["yolo_model"].run_yoloe(image, objects)
-                else:
-                    seg_results = None
-                self.video_processor.set_seg_classes(objects, seg_results)
+                self.start_segmentation(graph, image, objects)
+                self.start_speech(graph, response_text)
                 st.markdown(response_text)
-                response_bytes, response_base64 = text_to_speech(self.session, response_text)
-                if response_base64:
-                    st.audio(response_bytes, format="audio/wav", start_time=0)
-                    audio_html = f"""
-                        <audio autoplay>
-                          <source src="data:audio/wav;base64,{response_base64}" type="audio/wav" />
-                          Your browser does not support the audio element.
-                        </audio>
-                        """
-                    components.html(audio_html, height=1)
+                self.render_stages(graph)
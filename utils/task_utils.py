@@ -0,0 +1,115 @@
+import concurrent.futures
+import threading
+import time
+import streamlit as st
+
+
+class TaskGraph:
+    def __init__(self, executor):
+        self.executor = executor
+        self.tasks = {}
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def add(self, name, fn, *args, deps=(), timeout=None):
+        task = {
+            "fn": fn,
+            "args": args,
+            "deps": list(deps),
+            "timeout": timeout,
+            "deadline": None,
+            "timed_out": False,
+            "consumed": False,
+            "future": concurrent.futures.Future()
+        }
+        with self.lock:
+            self.tasks[name] = task
+        dep_futures = [self.tasks[dep]["future"] for dep in task["deps"]]
+        if not dep_futures:
+            self._submit(task)
+            return task["future"]
+
+        remaining = [len(dep_futures)]
+
+        def on_dep_done(_):
+            with self.lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self._submit(task)
+
+        for dep_future in dep_futures:
+            dep_future.add_done_callback(on_dep_done)
+        return task["future"]
+
+    def _submit(self, task):
+        dep_results = []
+        for dep in task["deps"]:
+            dep_task = self.tasks[dep]
+            dep_future = dep_task["future"]
+            if dep_task["timed_out"] or dep_future.cancelled() or dep_future.exception() is not None:
+                task["future"].cancel()
+                return
+            dep_results.append(dep_future.result())
+        if self.cancelled:
+            task["future"].cancel()
+            return
+        if task["timeout"] is not None:
+            task["deadline"] = time.monotonic() + task["timeout"]
+        self.executor.submit(self._run, task, dep_results)
+
+    def _run(self, task, dep_results):
+        future = task["future"]
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = task["fn"](*task["args"], *dep_results)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def cancel(self):
+        self.cancel_event.set()
+        with self.lock:
+            tasks = list(self.tasks.values())
+        for task in tasks:
+            task["future"].cancel()
+
+    def as_completed(self, block=True, poll_interval=0.05):
+        # yields (name, result, error) once per task, in completion order
+        while True:
+            with self.lock:
+                pending = [(name, task) for name, task in self.tasks.items() if not task["consumed"]]
+            if not pending:
+                return
+            now = time.monotonic()
+            for name, task in pending:
+                future = task["future"]
+                if future.cancelled():
+                    task["consumed"] = True
+                    yield name, None, concurrent.futures.CancelledError(f"{name} was cancelled")
+                elif future.done():
+                    task["consumed"] = True
+                    yield name, future.result() if future.exception() is None else None, future.exception()
+                elif task["deadline"] is not None and now > task["deadline"]:
+                    task["consumed"] = True
+                    task["timed_out"] = True
+                    future.cancel()
+                    for dependent in self.tasks.values():
+                        if name in dependent["deps"]:
+                            dependent["future"].cancel()
+                    yield name, None, TimeoutError(f"{name} timed out after {task['timeout']}s")
+            if not block:
+                return
+            concurrent.futures.wait([task["future"] for _, task in pending], timeout=poll_interval,
+                                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+
+@st.cache_resource
+def get_executor(max_workers=8):
+    return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="request")
@@ -4,113 +4,239 @@ import time
 import streamlit as st
 from streamlit_webrtc import VideoProcessorBase
 import cv2
+from utils.cv_utils import fit_memory_budget, KeyframeScheduler, bind_tracks, propagate_segmentation, TrackHistory
+from utils.pipeline_utils import LatestSlot, PipelineStage, QualityGovernor, SKIPPED
+from utils.inference_utils import InferenceClient
 
 
 class FrameCaptureProcessor(VideoProcessorBase):
-    def __init__(self, yolo_model, show_bb, dynamic_segmentation):
+    def __init__(self, yolo_model, show_bb, dynamic_segmentation, inference_service=None):
         super().__init__()
         self.yolo_model = yolo_model
+        self.inference_client = InferenceClient(inference_service) if inference_service is not None else None
+        self.tracker = yolo_model.create_tracker()
         self.show_bb = show_bb
         self.dynamic_segmentation = dynamic_segmentation
         self.lock = threading.Lock()
-        self.latest_frame = None
         self.latest_boxes = None
+        self.scene_tracking = False
+        self.track_history = TrackHistory()
+        self.latest_detections = None
         self.seg_classes = None
         self.latest_seg_results = None
         self.seg_timestamp = None
         self.seg_duration = 20  # seconds
+        self.seg_version = 0
+        self.seg_sync_version = None  # the version set_seg_classes published, which recv must draw itself
+        self.seg_memory_budget = 4 * 1024 * 1024  # bytes of mask data per session
+        self.keyframes = KeyframeScheduler()
+        self.governor = QualityGovernor()
+        self.frames_dropped = 0
+        self.keyframe_seg_results = None
+        self.overlay = None
+        self.overlay_key = None
+        self.prepared_overlay = None
+        self.released = False
 
-        self.processing_thread = None
-        self.stop_event = threading.Event()
-        self.stop_event.clear()
-        self.processing_thread = threading.Thread(target=self._processing_loop)
-        self.processing_thread.start()
+        # recv decodes and publishes frames; each stage takes the newest input and hands its result on
+        self.frames = LatestSlot()
+        self.seg_inputs = LatestSlot()
+        self.overlay_inputs = LatestSlot()
+        self.stages = [
+            PipelineStage("detection", self._detect, self.frames, self.seg_inputs, self._on_stage_error),
+            PipelineStage("segmentation", self._segment, self.seg_inputs, self.overlay_inputs, self._on_stage_error),
+            PipelineStage("overlay", self._prepare_overlay, self.overlay_inputs, on_error=self._on_stage_error)
+        ]
+        for stage in self.stages:
+            stage.start()
 
-    def _processing_loop(self):
-        while not self.stop_event.is_set():
-            frame_to_process = None
+    def _detect(self, frame):
+        with self.lock:
+            local_show_bb = self.show_bb
+            local_seg_classes = self.seg_classes
+            dynamic_segmentation = self.dynamic_segmentation
+            scene_tracking = self.scene_tracking
+        if not self.governor.should_process():
+            return SKIPPED
+        imgsz = self.governor.imgsz
+        detections = None
+        # dynamic segmentation needs track ids to carry masks between keyframes
+        if local_show_bb or scene_tracking or (dynamic_segmentation and local_seg_classes):
+            if self.inference_client is not None:
+                detections = self.tracker.update(self.inference_client.detect(frame, imgsz))
+            else:
+                detections = self.yolo_model.detect(frame, self.tracker, imgsz)
+        with self.lock:
+            self.latest_boxes = detections if local_show_bb else None
+            if scene_tracking and detections is not None:
+                self.track_history.update(detections, frame.shape, time.monotonic())
+                self.latest_detections = (detections, frame.shape)
+        # frames recv published that no stage ever took since the last detection
+        backlog = self.frames.dropped - self.frames_dropped
+        self.frames_dropped = self.frames.dropped
+        self.governor.observe(1000 * (time.perf_counter() - self.frames.taken_at), backlog)
+        if dynamic_segmentation:
+            return frame, detections, local_seg_classes, imgsz
+        return None
 
+    def _segment(self, item):
+        frame, detections, seg_classes, imgsz = item
+        if not seg_classes:
+            self.keyframes.reset()
             with self.lock:
-                if self.latest_frame is not None:
-                    frame_to_process = self.latest_frame.copy()
-                local_show_bb = self.show_bb
-                local_seg_classes = self.seg_classes
-                dynamic_segmentation = self.dynamic_segmentation
-
-            if frame_to_process is not None:
-                try:
-                    if local_show_bb:
-                        yolo_results = self.yolo_model.track(frame_to_process)
-                        with self.lock:
-                            self.latest_boxes = yolo_results[0]
-                    else:
-                        with self.lock:
-                            self.latest_boxes = None
-
-                    if dynamic_segmentation:
-                        if local_seg_classes:
-                            segmentation_results = self.yolo_model.run_yoloe(frame_to_process, local_seg_classes)
-                            with self.lock:
-                                self.latest_seg_results = segmentation_results
-                        else:
-                            with self.lock:
-                                self.latest_seg_results = None
-                except Exception as e:
-                    st.error(f"YOLO processing error: {e}")
-                    with self.lock:
-                        self.latest_boxes = None
-                        self.latest_seg_results = None
-            time.sleep(0.01)
+                self.latest_seg_results = None
+            return None
+        # under load the governor pauses YOLOE and the last keyframe's masks keep being propagated
+        is_keyframe, global_shift = self.keyframes.update(frame, seg_classes,
+                                                          allow_keyframe=not self.governor.seg_paused)
+        if is_keyframe:
+            segmentation_results = self.yolo_model.run_yoloe(frame, seg_classes, imgsz)
+            segmentation_results = fit_memory_budget(segmentation_results, self.seg_memory_budget)
+            self.keyframe_seg_results = bind_tracks(segmentation_results, detections)
+        else:
+            segmentation_results = propagate_segmentation(self.keyframe_seg_results, detections,
+                                                          global_shift, frame.shape)
+        with self.lock:
+            self.latest_seg_results = segmentation_results
+            self.seg_version += 1
+            seg_version = self.seg_version
+        return seg_version, segmentation_results, frame.shape
+
+    def _prepare_overlay(self, item):
+        seg_version, segmentation_results, frame_shape = item
+        overlay = self.yolo_model.build_overlay(segmentation_results or [], frame_shape)
+        with self.lock:
+            self.prepared_overlay = ((seg_version, frame_shape), overlay)
+
+    def _on_stage_error(self, stage_name, error):
+        st.error(f"YOLO {stage_name} error: {error}")
+        with self.lock:
+            self.latest_boxes = None
+            self.latest_seg_results = None
+            self.prepared_overlay = None
 
     def set_seg_classes(self, seg_classes, seg_results):
         with self.lock:
             self.seg_classes = seg_classes
             if seg_results:
-                self.latest_seg_results = seg_results
+                self.latest_seg_results = fit_memory_budget(seg_results, self.seg_memory_budget)
             else:
                 self.latest_seg_results = None
             self.seg_timestamp = time.time()
+            self.seg_version += 1
+            self.seg_sync_version = self.seg_version
+
+    def set_scene_tracking(self, enabled):
+        with self.lock:
+            self.scene_tracking = enabled
+            if not enabled:
+                self.track_history = TrackHistory()
+                self.latest_detections = None
 
-    def _draw_segmentation(self, img, segmentation_results):
-        img = self.yolo_model.draw_segmentation_on_image(img, segmentation_results)
-        return img
+    def get_scene(self):
+        # the latest tracked detections with direction, distance and motion, for the LLM prompt
+        with self.lock:
+            if self.latest_detections is None:
+                return []
+            detections, frame_shape = self.latest_detections
+            return self.track_history.describe(detections, frame_shape)
+
+    def _draw_segmentation(self, img, segmentation_results, seg_version, seg_sync_version):
+        # the overlay only changes with the segmentation result or the frame size, not per frame
+        if self.overlay_key != (seg_version, img.shape):
+            with self.lock:
+                prepared_overlay = self.prepared_overlay
+            # versions before the last set_seg_classes belong to the previous classes
+            oldest = seg_sync_version or 0
+            shown = self.overlay_key[0] if self.overlay is not None and self.overlay_key[1] == img.shape else None
+            if (prepared_overlay is not None and prepared_overlay[0][1] == img.shape and
+                    prepared_overlay[0][0] >= oldest and (shown is None or prepared_overlay[0][0] > shown)):
+                self.overlay_key, self.overlay = prepared_overlay
+            elif shown is None or shown < oldest:
+                # nothing usable is on screen and no overlay stage prepares results set from outside the pipeline
+                self.overlay = self.yolo_model.build_overlay(segmentation_results, img.shape)
+                self.overlay_key = (seg_version, img.shape)
+            # otherwise keep compositing the last overlay while the overlay stage catches up
+        return self.overlay.apply(img)
 
     def recv(self, frame):
         img = frame.to_ndarray(format="rgb24")
+        self.frames.put(img.copy())
         with self.lock:
-            self.latest_frame = img.copy()
             boxes = self.latest_boxes
             seg_results = self.latest_seg_results
             seg_classes = self.seg_classes
             seg_time = self.seg_timestamp
+            seg_version = self.seg_version
+            seg_sync_version = self.seg_sync_version
 
         if self.show_bb and boxes is not None:
             img = self.yolo_model.draw_boxes(img, boxes)
         if seg_classes and seg_results is not None and seg_time is not None:
             elapsed_time = time.time() - seg_time
             if elapsed_time <= self.seg_duration:
-                img = self._draw_segmentation(img, seg_results)
+                img = self._draw_segmentation(img, seg_results, seg_version, seg_sync_version)
             else:
                 with self.lock:
                     self.seg_classes = None
                     self.latest_seg_results = None
                     self.seg_timestamp = None
+                self.overlay = None
+                self.overlay_key = None
 
         frame = av.VideoFrame.from_ndarray(img, format="rgb24")
         return frame
 
     def get_latest_frame(self):
+        latest_frame = self.frames.peek()
+        if latest_frame is not None:
+            return latest_frame.copy()
+        return None
+
+    def get_stats(self):
+        stats = {
+            "frames_received": self.frames.seq,
+            "frames_processed": self.stages[0].processed,
+            "frames_skipped": self.stages[0].skipped,
+            "frames_dropped": self.frames.dropped,
+            "seg_keyframes": self.keyframes.keyframes,
+            "seg_propagated": self.keyframes.propagated
+        }
+        stats.update(self.memory_usage())
+        stats["stages"] = {stage.name: stage.stats() for stage in self.stages}
+        stats["governor"] = self.governor.stats()
+        return stats
+
+    def memory_usage(self):
+        latest_frame = self.frames.peek()
         with self.lock:
-            if self.latest_frame is not None:
-                return self.latest_frame.copy()
-            return None
+            seg_results = self.latest_seg_results or []
+        overlay = self.overlay
+        return {
+            "frame_bytes": latest_frame.nbytes if latest_frame is not None else 0,
+            "mask_bytes": sum(r["mask"].nbytes for r in seg_results),
+            "overlay_bytes": overlay.nbytes if overlay is not None else 0
+        }
+
+    def on_ended(self):
+        # streamlit-webrtc calls this when the session's stream stops; nothing calls release directly
+        self.release()
 
     def release(self):
-        if self.processing_thread and self.processing_thread.is_alive():
-            self.stop_event.set()
-            self.processing_thread.join()
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        try:
+            for stage in self.stages:
+                stage.stop()
+        finally:
+            if self.inference_client is not None:
+                self.inference_client.close()
+        self.tracker.reset()
 
+        self.frames.clear()
         with self.lock:
-            self.latest_frame = None
             self.latest_boxes = None
             self.latest_seg_results = None
+            self.prepared_overlay = None